@@ -0,0 +1,172 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from fat_dir_entry import FatDirEntry
+from fat_file import FatFile
+
+
+class AsyncFat8:
+    """
+    asyncio front end of Fat8, blocking calls run in executor with bounded number of worker threads
+    Concurrent requests for the same block (for the same file name in open and for the same range of file
+    in reads of descriptors) share one call in executor
+    executor - own executor, max_workers is used only if it is not given
+    """
+    def __init__(self, fs, executor=None, max_workers=4):
+        if executor is None and max_workers < 1:
+            raise ValueError("Executor needs at least one worker")
+        self.fs = fs
+        self.own_executor = executor is None
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="fat8") if executor is None else executor
+        self.in_flight = {}     # key of request -> future of call which is running in executor
+
+    def __repr__(self):
+        return f"AsyncFat8(in flight: {len(self.in_flight)})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def run(self, func, *args):
+        """Run blocking function in executor and return its result"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def single_flight(self, key, func, *args):
+        """Run blocking function in executor, callers with the same key wait for the call which is running"""
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.run(func, *args))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        # cancelled caller does not cancel call of other callers
+        return await asyncio.shield(future)
+
+    def _read_blocks(self, block_id, count):
+        return bytes(self.fs.data_block_read(block_id, count))
+
+    async def read_block(self, block_id):
+        """Return data of one block of drive"""
+        return await self.single_flight(("blocks", block_id, 1), self._read_blocks, block_id, 1)
+
+    async def read_blocks(self, block_id, count):
+        """Return data of count consecutive blocks of drive"""
+        return await self.single_flight(("blocks", block_id, count), self._read_blocks, block_id, count)
+
+    async def read_dir(self):
+        """Return list of files in (root) directory"""
+        return await self.single_flight(("read_dir",), FatDirEntry.read_dir, self.fs)
+
+    def file(self, file_name):
+        return AsyncFatFile(self, file_name)
+
+    async def flush(self):
+        await self.run(self.fs.flush)
+
+    async def close(self):
+        """Close file system, own executor is shut down after all calls in it are finished"""
+        await self.run(self.fs.close)
+        if self.own_executor:
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+
+class AsyncFatFile:
+    """FatFile which is opened and deleted in executor of AsyncFat8"""
+    def __init__(self, afs, file_name):
+        self.afs = afs
+        self.file = FatFile(afs.fs, file_name)
+        self.fat_fd = None
+
+    def is_open(self):
+        return self.fat_fd is not None
+
+    async def open(self, page_window=None):
+        """Find/Create file and return instance of AsyncFatFd"""
+        if self.is_open():
+            return self.fat_fd
+
+        # file which does not exist is created only once, even if it is opened by more coroutines
+        await self.afs.single_flight(("open", self.file.file_name), FatDirEntry.open, self.afs.fs,
+                                     self.file.file_name)
+        fat_fd = await self.afs.run(self.file.open, page_window)
+        self.fat_fd = AsyncFatFd(self.afs, fat_fd)
+        return self.fat_fd
+
+    def close(self):
+        self.file.close()
+        self.fat_fd = None
+
+    async def delete(self, wipe=False):
+        await self.afs.run(self.file.delete, wipe)
+        self.fat_fd = None
+
+
+class AsyncFatFd:
+    """FatFd with methods running in executor of AsyncFat8, descriptor of each file can be used by its coroutine"""
+    def __init__(self, afs, fat_fd):
+        self.afs = afs
+        self.fat_fd = fat_fd
+
+    async def stat(self):
+        return await self.afs.run(self.fat_fd.stat)
+
+    async def tell(self):
+        return await self.afs.run(self.fat_fd.tell)
+
+    async def seek(self, position):
+        await self.afs.run(self.fat_fd.seek, position)
+
+    async def truncate(self, size):
+        await self.afs.run(self.fat_fd.truncate, size)
+
+    async def _read_at(self, position, size):
+        """Return at most size bytes of file from position, descriptors reading the same range share one call"""
+        key = ("file", self.fat_fd.fat_dir_entry.fst_cluster_id, position, size)
+        return await self.afs.single_flight(key, self.fat_fd.pread, position, size)
+
+    async def read(self, size):
+        # position is read without lock of descriptor, it could be held by shared read of other coroutine
+        position = self.fat_fd.file_offset
+        if size > self.fat_fd.file_size - position:
+            return ''
+        data = await self._read_at(position, size)
+        self.fat_fd.file_offset = position + size
+        return data.decode('utf-8').rstrip('\0')
+
+    async def write(self, data):
+        await self.afs.run(self.fat_fd.write, data)
+
+    async def readinto(self, buffer):
+        """Read bytes from current position to writable buffer, return number of bytes read (0 at end of file)"""
+        view = memoryview(buffer).cast('B')
+        position = self.fat_fd.file_offset
+        data = await self._read_at(position, len(view))
+        view[:len(data)] = data
+        self.fat_fd.file_offset = position + len(data)
+        return len(data)
+
+    async def iter_chunks(self, chunk_size=None):
+        """Yield bytes of file from current position to its end in chunks, every chunk is read in executor"""
+        if chunk_size is None:
+            chunk_size = self.fat_fd.cluster_size
+        if chunk_size < 1:
+            raise ValueError("Size of chunk has to be positive")
+        buffer = bytearray(chunk_size)
+        while True:
+            read = await self.readinto(buffer)
+            if read == 0:
+                return
+            yield bytes(buffer[:read])
+
+    async def write_from(self, chunks):
+        """Write binary chunks from iterable or async iterable, return number of written bytes"""
+        if not hasattr(chunks, "__aiter__"):
+            return await self.afs.run(self.fat_fd.write_from, chunks)
+        total = 0
+        async for chunk in chunks:
+            total += await self.afs.run(self.fat_fd.write_from, [chunk])
+        return total
+
+    async def flush(self):
+        await self.afs.run(self.fat_fd.flush)
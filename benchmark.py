@@ -0,0 +1,331 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from time import perf_counter
+
+from cache import Cache
+from constants import *
+from fat8 import Fat8
+from fat_file import FatFile
+from read_ahead import ReadAhead
+from stats import Stats
+from striped_virtual_drive import STRIPE_BLOCKS, StripedVirtualDrive
+from virtual_drive import VirtualDrive
+
+WORKLOADS = ['format', 'small_files', 'sequential', 'random', 'append', 'cache_sweep']
+
+
+def new_drive(directory, name, drive_blocks, stripes=1, stripe_blocks=STRIPE_BLOCKS):
+    """
+    Create and open fresh drive, return (drive, paths of its backing files)
+    With more stripes the drive is StripedVirtualDrive over files name0.img, name1.img, ...
+    """
+    if stripes > 1:
+        paths = [os.path.join(directory, f'{name}{idx}.img') for idx in range(stripes)]
+    else:
+        paths = [os.path.join(directory, f'{name}.img')]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    if stripes > 1:
+        StripedVirtualDrive.manufacture(paths, drive_blocks, stripe_blocks)
+        return StripedVirtualDrive.open(paths, stripe_blocks), paths
+    VirtualDrive.manufacture(paths[0], drive_blocks)
+    return VirtualDrive.open(paths[0]), paths
+
+
+class Image:
+    """
+    Fresh drive with formatted Fat8 and Cache with Stats for one run of workload
+    With more stripes the drive is StripedVirtualDrive over files bench0.img, bench1.img, ...
+    """
+    def __init__(self, directory, drive_blocks, cache_blocks, write_back=False, read_ahead=False, quick=True,
+                 version=1, stripes=1, stripe_blocks=STRIPE_BLOCKS):
+        self.drive, self.paths = new_drive(directory, 'bench', drive_blocks, stripes, stripe_blocks)
+        self.stats = Stats()
+        self.cache = Cache(self.drive, cache_blocks, write_back, read_ahead=ReadAhead() if read_ahead else None,
+                           stats=self.stats)
+        self.fs = Fat8()
+        self.fs.format(self.cache, quick, version)
+        self.fs.open(self.cache)
+        # only I/O of workload is reported
+        self.stats.reset()
+
+    def close(self):
+        self.fs.close()
+        self.drive.close()
+        for path in self.paths:
+            os.remove(path)
+
+
+def percentile(values, percent):
+    """Return percentile of measured values (nearest rank)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+def report(workload, params, latencies, seconds, data_bytes=0, stats=None):
+    """Return result of one run, latencies of operations are in seconds"""
+    result = {
+        'workload': workload,
+        'params': params,
+        'ops': len(latencies),
+        'seconds': seconds,
+        'ops_per_s': len(latencies) / seconds if seconds else None,
+        'mb_per_s': data_bytes / seconds / 1e6 if seconds and data_bytes else None,
+        'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+    }
+    if stats is not None:
+        counters = stats.snapshot()['counters']
+        result['io'] = {name: counters.get(name, 0) for name in
+                        ('drive_reads', 'drive_writes', 'drive_read_bytes', 'drive_write_bytes',
+                         'drive_discarded_blocks')}
+        hits = sum(counters.get('cache_hits', {}).values())
+        misses = sum(counters.get('cache_misses', {}).values())
+        result['cache'] = {'hits': hits, 'misses': misses,
+                           'hit_ratio': hits / (hits + misses) if hits + misses else None,
+                           'evictions': sum(counters.get('cache_evictions', {}).values())}
+    return result
+
+
+def measure(operations):
+    """Run operations (functions without arguments), return their latencies and total time"""
+    latencies = []
+    began = perf_counter()
+    for operation in operations:
+        start = perf_counter()
+        operation()
+        latencies.append(perf_counter() - start)
+    return latencies, perf_counter() - began
+
+
+def bench_format(args, directory):
+    results = []
+    for drive_blocks in args.drive_sizes:
+        for quick in (True, False):
+            latencies = []
+            # I/O of all repetitions is counted together
+            stats = Stats()
+            for _ in range(args.repeat):
+                drive, paths = new_drive(directory, 'format', drive_blocks, args.stripes, args.stripe_blocks)
+                cache = Cache(drive, args.cache_blocks, stats=stats)
+                fs = Fat8()
+                start = perf_counter()
+                fs.format(cache, quick, args.fs_version)
+                fs.flush()
+                latencies.append(perf_counter() - start)
+                fs.close()
+                drive.close()
+                for path in paths:
+                    os.remove(path)
+            results.append(report('format', {'drive_blocks': drive_blocks, 'quick': quick, 'repeat': args.repeat},
+                                  latencies, sum(latencies), stats=stats))
+    return results
+
+
+def bench_small_files(args, directory):
+    image = Image(directory, args.drive_blocks, args.cache_blocks, args.write_back, version=args.fs_version,
+                  stripes=args.stripes, stripe_blocks=args.stripe_blocks)
+    count = min(args.files, len(image.fs.root_dir.free_slots), image.fs.free_clusters_count())
+    names = [f'f{idx:05d}' for idx in range(count)]
+    payload = b's' * args.small_size
+    results = []
+
+    def create(name):
+        return lambda: FatFile(image.fs, name).open().write_from([payload])
+
+    def reopen(name):
+        return lambda: FatFile(image.fs, name).open().readinto(bytearray(args.small_size))
+
+    def delete(name):
+        return lambda: FatFile(image.fs, name).delete()
+
+    for phase, factory in (('create', create), ('open', reopen), ('delete', delete)):
+        image.stats.reset()
+        latencies, seconds = measure([factory(name) for name in names])
+        results.append(report('small_files', {'phase': phase, 'files': count, 'size': args.small_size},
+                              latencies, seconds, count * args.small_size, image.stats))
+    image.close()
+    return results
+
+
+def _file_chunks(file_size, chunk):
+    return [(position, min(chunk, file_size - position)) for position in range(0, file_size, chunk)]
+
+
+def _io_workload(args, directory, workload, cache_blocks, shuffle):
+    image = Image(directory, args.drive_blocks, cache_blocks, args.write_back, args.read_ahead,
+                  version=args.fs_version, stripes=args.stripes, stripe_blocks=args.stripe_blocks)
+    fd = FatFile(image.fs, 'data').open()
+    file_size = min(args.file_size, image.fs.free_clusters_count() * fd.cluster_size)
+    fd.truncate(file_size)
+    chunks = _file_chunks(file_size, args.chunk)
+    if shuffle:
+        random.Random(args.seed).shuffle(chunks)
+    buffer = bytearray(args.chunk)
+    data = bytes(random.Random(args.seed).getrandbits(8) for _ in range(args.chunk))
+
+    def write(position, size):
+        def operation():
+            fd.seek(position)
+            fd.write_from([memoryview(data)[:size]])
+        return operation
+
+    def read(position, size):
+        def operation():
+            fd.seek(position)
+            fd.readinto(memoryview(buffer)[:size])
+        return operation
+
+    results = []
+    params = {'file_size': file_size, 'chunk': args.chunk, 'cache_blocks': cache_blocks,
+              'write_back': args.write_back, 'read_ahead': args.read_ahead}
+    for phase, factory in (('write', write), ('read', read)):
+        image.stats.reset()
+        if phase == 'read':
+            # reads start with cold cache
+            image.cache.clear_cache()
+            image.stats.reset()
+        latencies, seconds = measure([factory(position, size) for position, size in chunks])
+        if phase == 'write':
+            start = perf_counter()
+            image.fs.flush()
+            seconds += perf_counter() - start
+        results.append(report(workload, dict(params, phase=phase), latencies, seconds, file_size, image.stats))
+    image.close()
+    return results
+
+
+def bench_sequential(args, directory):
+    return _io_workload(args, directory, 'sequential', args.cache_blocks, False)
+
+
+def bench_random(args, directory):
+    return _io_workload(args, directory, 'random', args.cache_blocks, True)
+
+
+def bench_append(args, directory):
+    image = Image(directory, args.drive_blocks, args.cache_blocks, args.write_back, version=args.fs_version,
+                  stripes=args.stripes, stripe_blocks=args.stripe_blocks)
+    fd = FatFile(image.fs, 'log').open()
+    max_size = image.fs.free_clusters_count() * fd.cluster_size
+    record = b'a' * args.chunk
+    appended = [0]
+
+    def append():
+        # file is grown with truncate and record is written behind the old end
+        position = appended[0]
+        if position + len(record) > fd.stat():
+            fd.truncate(position + len(record))
+        fd.seek(position)
+        fd.write_from([record])
+        appended[0] += len(record)
+
+    count = min(args.appends, max_size // len(record))
+    latencies, seconds = measure([append] * count)
+    result = report('append', {'appends': count, 'record': len(record)}, latencies, seconds,
+                    count * len(record), image.stats)
+    image.close()
+    return [result]
+
+
+def bench_cache_sweep(args, directory):
+    results = []
+    for cache_blocks in args.cache_sizes:
+        results += _io_workload(args, directory, 'cache_sweep', cache_blocks, True)
+    return results
+
+
+def git_commit():
+    """Return commit of repository with benchmark or None"""
+    head = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.git', 'HEAD')
+    try:
+        with open(head) as head_file:
+            ref = head_file.read().strip()
+        if not ref.startswith('ref: '):
+            return ref
+        with open(os.path.join(os.path.dirname(head), ref[5:])) as ref_file:
+            return ref_file.read().strip()
+    except OSError:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of Cache, VirtualDrive, Fat8 and FatFd")
+    parser.add_argument('workloads', nargs='*', default=[],
+                        help="workloads to run (all by default)")
+    parser.add_argument('--drive-blocks', type=int, default=8000, help="size of drive in blocks")
+    parser.add_argument('--drive-sizes', type=int, nargs='+', default=[2000, 8000, 32000, 128000],
+                        help="sizes of drive (in blocks) for format workload")
+    parser.add_argument('--cache-blocks', type=int, default=64, help="capacity of cache in blocks")
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=[8, 32, 128, 512],
+                        help="capacities of cache for cache_sweep workload")
+    parser.add_argument('--write-back', action='store_true', help="use write back cache")
+    parser.add_argument('--read-ahead', action='store_true', help="use read ahead of cache")
+    parser.add_argument('--fs-version', type=int, choices=[1, 2], default=1,
+                        help="version of file system (version 2 has journal of metadata)")
+    parser.add_argument('--stripes', type=int, default=1, help="number of backing files of striped drive")
+    parser.add_argument('--stripe-blocks', type=int, default=STRIPE_BLOCKS, help="blocks of one stripe")
+    parser.add_argument('--files', type=int, default=200, help="number of small files")
+    parser.add_argument('--small-size', type=int, default=300, help="size of small file in bytes")
+    parser.add_argument('--file-size', type=int, default=1 << 20, help="size of file for read/write workloads")
+    parser.add_argument('--chunk', type=int, default=4096, help="size of one read/write in bytes")
+    parser.add_argument('--appends', type=int, default=500, help="number of appends")
+    parser.add_argument('--repeat', type=int, default=3, help="repetitions of format")
+    parser.add_argument('--seed', type=int, default=0, help="seed of random workloads")
+    parser.add_argument('--dir', default=None, help="directory for images (temporary by default)")
+    parser.add_argument('--output', '-o', default=None, help="write JSON to file instead of standard output")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Run workloads and return JSON serializable report"""
+    workloads = args.workloads or WORKLOADS
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            raise ValueError(f"Unknown workload {workload}, choose from {', '.join(WORKLOADS)}")
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for workload in workloads:
+            results += globals()[f'bench_{workload}'](args, directory)
+    return {'meta': meta(args), 'results': results}
+
+
+def meta(args):
+    """Return description of run for JSON report, arguments without output and directory of images"""
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'block_size': BLOCK_SIZE,
+        'args': {name: value for name, value in vars(args).items() if name not in ('output', 'dir')},
+    }
+
+
+def write_report(result, output=None, ok=True):
+    """Write JSON report to file output (standard output if it is None), return exit code (1 if not ok)"""
+    text = json.dumps(result, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, 'w') as output_file:
+            output_file.write(text + '\n')
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    return write_report(run(args), args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,18 +1,28 @@
 class Block:
     """Data block for cache"""
+    __slots__ = ('data', 'block_id', 'ready_to_delete', 'dirty', 'prefetched', 'prev', 'next')
+
     def __init__(self, block_id, ready_to_delete=False, data=None):
         self.data = data
         self.block_id = block_id
         self.ready_to_delete = ready_to_delete
+        self.dirty = False  # data is newer than on virtual drive (write back mode)
+        self.prefetched = False  # block was read ahead and it was not used yet
+        # neighbours in the second chance ring of the cache
+        self.prev = None
+        self.next = None
 
     def __eq__(self, other):
         if isinstance(other, Block):
             return self.block_id == other.block_id
         return False
 
-    def put_single_data(self, index, data):
-        arr = bytearray(self.data)
-        for i in range(len(data)):
-            arr[index + i] = data[i]
-        self.data = bytes(arr)
+    def __hash__(self):
+        return hash(self.block_id)
 
+    def put_single_data(self, index, data):
+        """Overwrite part of block from index, data are changed in place once block holds its own bytearray"""
+        if not isinstance(self.data, bytearray):
+            # bytes or view of mapped drive are copied only once
+            self.data = bytearray(self.data)
+        self.data[index:index + len(data)] = data
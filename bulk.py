@@ -0,0 +1,169 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+from constants import *
+from fat_dir_entry import FatDirEntry
+
+
+def _host_files(paths):
+    """Return host files from paths, directory is replaced by files in it (not recursively)"""
+    if isinstance(paths, (str, bytes, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(entry.path for entry in os.scandir(path) if entry.is_file())
+        else:
+            files.append(path)
+    return files
+
+
+def _bounded_map(executor, func, items, window):
+    """Like executor.map, but at most window calls are submitted ahead of consumer"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _runs(clusters):
+    """Split cluster chain to runs of consecutive clusters, return (index in chain, first cluster, length)"""
+    runs = []
+    for index, cluster_id in enumerate(clusters):
+        if runs and runs[-1][1] + runs[-1][2] == cluster_id:
+            runs[-1][2] += 1
+        else:
+            runs.append([index, cluster_id, 1])
+    return runs
+
+
+def _check_host_name(name):
+    """Raise ValueError if file name read from image could leave destination directory on host"""
+    separators = [separator for separator in (os.sep, os.altsep) if separator]
+    if name in ('', '.', '..') or '\0' in name or any(separator in name for separator in separators) or \
+            os.path.isabs(name) or os.path.splitdrive(name)[0]:
+        raise ValueError(f"File name {name!r} can not be exported to host directory")
+
+
+def _data_length(data):
+    """Return length of data without trailing zero bytes, only the last block with data is copied"""
+    view = memoryview(data)
+    zero_block = bytes(BLOCK_SIZE)
+    end = len(view)
+    while end > 0:
+        start = max(0, end - BLOCK_SIZE)
+        if view[start:end] != zero_block[:end - start]:
+            return start + len(view[start:end].tobytes().rstrip(b'\0'))
+        end = start
+    return 0
+
+
+def _write_root_blocks(fs, placed):
+    """Write new entries to root directory, every changed block is written once"""
+    by_block = {}
+    for block_id, index_in_block, fde in placed:
+        by_block.setdefault(block_id, []).append((index_in_block, fde))
+    for block_id in sorted(by_block):
+        root_block = bytearray(fs.read_metadata_block(block_id))
+        for index_in_block, fde in by_block[block_id]:
+            entry = fde.to_binary()
+            root_block[index_in_block:index_in_block + len(entry)] = entry
+        fs.write_metadata_blocks(block_id, [root_block])
+
+
+def import_tree(fs, paths, workers=4):
+    """
+    Copy host files (or files of host directories) to root directory of file system
+    Clusters of all files are allocated at once and FAT is written once, host files are read by pool of workers
+    while data are written to drive. Return list of created FatDirEntry
+    """
+    host_files = _host_files(paths)
+    cluster_size = fs.blocks_per_clust * BLOCK_SIZE
+
+    # check names before anything is changed
+    sizes = []
+    names = set()
+    for path in host_files:
+        name = os.path.basename(os.fsdecode(path))
+        FatDirEntry(name, 0, 0, fs.layout)
+        if name in names:
+            raise ValueError(f"File {name} is imported more than once")
+        names.add(name)
+        # every file has at least one cluster
+        sizes.append((name, max(1, ceil(os.path.getsize(path) / cluster_size))))
+
+    with fs.transaction(), fs.dir_lock:
+        for name, _ in sizes:
+            if name in fs.root_dir:
+                raise ValueError(f"File {name} already exists")
+        if len(fs.root_dir.free_slots) < len(sizes):
+            raise ValueError("Not enough free entries in root directory")
+        if not fs.reclaim_clusters(sum(count for _, count in sizes)):
+            raise ValueError("Not enough empty clusters on drive")
+
+        chains = []
+        placed = []
+        for name, count in sizes:
+            clusters = fs.allocate_clusters(count)
+            fde = FatDirEntry(name, clusters[0], count, fs.layout)
+            placed.append(fs.root_dir.add(fde) + (fde,))
+            chains.append(clusters)
+        _write_root_blocks(fs, placed)
+
+    def read_host_file(item):
+        path, clusters = item
+        # data are padded by zeros to whole clusters, so old content of clusters is overwritten
+        data = bytearray(len(clusters) * cluster_size)
+        with open(path, 'rb') as host_file:
+            host_file.readinto(data)
+        return clusters, data
+
+    with ThreadPoolExecutor(workers) as executor:
+        for clusters, data in _bounded_map(executor, read_host_file, zip(host_files, chains), 2 * workers):
+            view = memoryview(data)
+            for index, cluster_id, length in _runs(clusters):
+                position = index * cluster_size
+                fs.data_block_write(fs.data_cluster_block(cluster_id), length * fs.blocks_per_clust,
+                                    view[position:position + length * cluster_size])
+
+    return [fde for _, _, fde in placed]
+
+
+def export_all(fs, dest, workers=4):
+    """
+    Copy all files of root directory to host directory dest, files are written by pool of workers
+    while next files are read from drive. Trailing zero bytes are not exported (size of file is in clusters)
+    Return list of paths of written host files, names which are not plain file names on host raise ValueError
+    """
+    entries = FatDirEntry.read_root_dir(fs)
+    # check names before anything is written
+    for fde in entries:
+        _check_host_name(fde.file_name)
+    os.makedirs(dest, exist_ok=True)
+    cluster_size = fs.blocks_per_clust * BLOCK_SIZE
+
+    def read_files():
+        for fde in entries:
+            clusters = fs.get_file_clusters(fde.fst_cluster_id)
+            data = bytearray(len(clusters) * cluster_size)
+            view = memoryview(data)
+            for index, cluster_id, length in _runs(clusters):
+                position = index * cluster_size
+                fs.data_block_readinto(fs.data_cluster_block(cluster_id), length * fs.blocks_per_clust,
+                                       view[position:position + length * cluster_size])
+            yield fde.file_name, data
+
+    def write_host_file(item):
+        name, data = item
+        path = os.path.join(dest, name)
+        with open(path, 'wb') as host_file:
+            host_file.write(memoryview(data)[:_data_length(data)])
+        return path
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(_bounded_map(executor, write_host_file, read_files(), 2 * workers))
@@ -1,72 +1,521 @@
-import collections
+import threading
+from time import perf_counter
+
 from block import Block
+from constants import BLOCK_SIZE
 from virtual_drive import VirtualDrive
 
+# number of latches shared by blocks, block uses latch block_id % LATCHES
+LATCHES = 64
+
 
 class Cache:
-    """Cache for virtual drive"""
-    def __init__(self, drive, capacity):
+    """
+    Cache for virtual drive
+    In write back mode written blocks are only marked dirty and go to the drive on eviction
+    (with consecutive dirty blocks around them), on flush/sync or when there is more than max_dirty dirty blocks
+    (quarter of capacity by default, so dirty blocks are mostly written sorted in batches)
+    With read_ahead (instance of ReadAhead) following blocks of sequential reads are prefetched,
+    they enter the ring as cold (ready to delete) so they are evicted before blocks which were used
+    Cache can be used from more threads, lock protects index and ring, latches serialize I/O of the same block
+    and reads of missing blocks and flush of dirty blocks are done without holding the lock
+    With stats (instance of Stats) hits, misses, evictions and I/O of virtual drive are measured
+    """
+    def __init__(self, drive, capacity, write_back=False, max_dirty=None, read_ahead=None, stats=None):
         if capacity < 1:
             raise ValueError("Not enough capacity")
         if not isinstance(drive, VirtualDrive):
             raise TypeError("Drive is not instance of VirtualDrive")
+        if max_dirty is not None and max_dirty < 1:
+            raise ValueError("Not enough dirty blocks allowed")
         self.drive = drive
         self.capacity = capacity
-        self.queue = collections.deque()
+        self.write_back = write_back
+        self.max_dirty = max_dirty if max_dirty is not None else max(1, capacity // 4)
+        self.blocks = {}    # block_id -> Block
+        self.hand = None    # oldest block in second chance ring, next candidate for eviction
+        self.dirty = set()  # ids of blocks which are not written to drive yet
+        self.lock = threading.RLock()
+        self.latches = [threading.Lock() for _ in range(LATCHES)]
+        self.versions = {}  # block_id -> [reads from drive in progress, writes since they began]
+        self.read_ahead = read_ahead
+        if read_ahead is not None:
+            # prefetched blocks can take at most half of the cache
+            read_ahead.max_window = max(1, min(read_ahead.max_window, capacity // 2))
+            read_ahead.min_window = min(read_ahead.min_window, read_ahead.max_window)
+            read_ahead.window = min(read_ahead.window, read_ahead.max_window)
+        self.stats = stats
+        if stats is not None:
+            stats.gauges['cache_blocks'] = lambda: len(self.blocks)
+            stats.gauges['cache_dirty_blocks'] = lambda: len(self.dirty)
+            stats.gauges['cache_capacity'] = lambda: self.capacity
+
+    def _drive_read(self, block_id):
+        if self.stats is None:
+            return self.drive.read(block_id)
+        began = perf_counter()
+        data = self.drive.read(block_id)
+        self.stats.drive_io('read', BLOCK_SIZE, perf_counter() - began)
+        return data
+
+    def _drive_read_blocks(self, start, count):
+        if self.stats is None:
+            return self.drive.read_blocks(start, count)
+        began = perf_counter()
+        data = self.drive.read_blocks(start, count)
+        self.stats.drive_io('read', count * BLOCK_SIZE, perf_counter() - began)
+        return data
+
+    def _drive_write(self, block):
+        if self.stats is None:
+            return self.drive.write(block)
+        began = perf_counter()
+        self.drive.write(block)
+        self.stats.drive_io('write', len(block.data), perf_counter() - began)
+
+    def _drive_write_blocks(self, start, buffers):
+        if self.stats is None:
+            return self.drive.write_blocks(start, buffers)
+        began = perf_counter()
+        self.drive.write_blocks(start, buffers)
+        self.stats.drive_io('write', sum(len(data) for data in buffers), perf_counter() - began)
+
+    def _count(self, name, block_id=None, value=1):
+        if self.stats is not None:
+            self.stats.inc(name, block_id, value)
+
+    def _latch(self, block_id):
+        return self.latches[block_id % LATCHES]
+
+    def _latches(self, block_ids):
+        """Return latches of blocks in the same order for every caller, so they can be taken without deadlock"""
+        return [self.latches[idx] for idx in sorted({block_id % LATCHES for block_id in block_ids})]
 
     def write(self, block_id, data):
-        """Write data to cache and then to disk"""
-        new_block = Block(block_id, False, data)
+        """Write data to cache and then to disk (in write back mode only mark block as dirty)"""
+        with self._latch(block_id):
+            with self.lock:
+                block = self._put(block_id, data)
+                if self.write_back:
+                    self._mark_dirty([block])
+            if not self.write_back:
+                # write through is done under latch only, other blocks can be used meanwhile
+                self._drive_write(block)
+                return
+        self._flush_over_limit()
+
+    def write_blocks(self, start, buffers):
+        """Write consecutive blocks to cache and then to disk with one call"""
+        latches = self._latches(range(start, start + len(buffers)))
+        for latch in latches:
+            latch.acquire()
+        try:
+            with self.lock:
+                for idx, data in enumerate(buffers):
+                    block = self._put(start + idx, data)
+                    if self.write_back:
+                        # block is dirty at once, so it is written out if the rest of buffers evicts it
+                        self._mark_dirty([block])
+            if not self.write_back:
+                self._drive_write_blocks(start, buffers)
+        finally:
+            for latch in reversed(latches):
+                latch.release()
+        if self.write_back:
+            self._flush_over_limit()
+
+    def _put(self, block_id, data):
+        """Put new data of block to cache"""
+        self._written(block_id)
+        block = self.blocks.get(block_id)
+        if block is None:
+            return self._insert(Block(block_id, False, data))
+        block.data = data
+        self._touch(block)
+        return block
+
+    def _mark_dirty(self, blocks):
+        for block in blocks:
+            if not block.dirty:
+                self._count('cache_dirtied', block.block_id)
+            block.dirty = True
+            self.dirty.add(block.block_id)
+
+    def _flush_over_limit(self):
+        """Flush dirty blocks if there is more than max_dirty of them, lock and latches must not be held"""
+        if len(self.dirty) > self.max_dirty:
+            self.flush()
+
+    def flush(self):
+        """Write all dirty blocks to virtual drive in order of block id, consecutive blocks with one call"""
+        self._flush_dirty(None)
+
+    def _flush_dirty(self, block_ids):
+        """
+        Write dirty blocks from block_ids (all if it is None) like _write_out_dirty, but without holding the lock
+        Latches of the blocks are held instead, so the blocks can not be changed meanwhile and other blocks can be used
+        """
+        with self.lock:
+            block_ids = set(self.dirty) if block_ids is None else self.dirty.intersection(block_ids)
+        if not block_ids:
+            return
+        latches = self._latches(block_ids)
+        for latch in latches:
+            latch.acquire()
+        try:
+            with self.lock:
+                runs = [(run, [block.data for block in run]) for run in self._dirty_runs(block_ids)]
+            for run, buffers in runs:
+                if len(run) == 1:
+                    self._drive_write(run[0])
+                else:
+                    self._drive_write_blocks(run[0].block_id, buffers)
+            with self.lock:
+                for run, _ in runs:
+                    self._count('cache_write_backs', value=len(run))
+                    for block in run:
+                        block.dirty = False
+                        self.dirty.discard(block.block_id)
+        finally:
+            for latch in reversed(latches):
+                latch.release()
+
+    def _dirty_runs(self, block_ids):
+        """Return runs of consecutive dirty blocks from block_ids in order of block id"""
+        runs = []
+        run = []
+        for block_id in sorted(self.dirty.intersection(block_ids)):
+            block = self.blocks[block_id]
+            if run and run[-1].block_id + 1 != block_id:
+                runs.append(run)
+                run = []
+            run.append(block)
+            # shorter block has to be the last one of the run
+            if len(block.data) != BLOCK_SIZE:
+                runs.append(run)
+                run = []
+        if run:
+            runs.append(run)
+        return runs
+
+    def _write_out_dirty(self, block_ids):
+        """Write dirty blocks from block_ids in order of block id under the lock, consecutive blocks with one call"""
+        for run in self._dirty_runs(block_ids):
+            self._write_out_run(run)
+
+    def _write_out_run(self, run):
+        if len(run) == 1:
+            self._write_out(run[0])
+            return
+        self._drive_write_blocks(run[0].block_id, [block.data for block in run])
+        self._count('cache_write_backs', value=len(run))
+        for block in run:
+            block.dirty = False
+            self.dirty.discard(block.block_id)
+
+    def sync(self):
+        """Flush dirty blocks and make them durable on virtual drive"""
+        self.flush()
+        self.drive.sync()
+
+    def sync_blocks(self, block_ids):
+        """Write dirty blocks from block_ids and make them durable on virtual drive, other dirty blocks stay"""
+        self._flush_dirty(block_ids)
+        self.drive.sync()
 
+    def write_around(self, start, buffers):
+        """
+        Write consecutive blocks straight to virtual drive and make them durable, also in write back mode
+        Blocks are not kept in cache (old copies are dropped), it is meant for blocks which are read only on open
+        """
+        latches = self._latches(range(start, start + len(buffers)))
+        for latch in latches:
+            latch.acquire()
+        try:
+            with self.lock:
+                for block_id in range(start, start + len(buffers)):
+                    self._written(block_id)
+                    block = self.blocks.get(block_id)
+                    if block is not None:
+                        block.dirty = False
+                        self.dirty.discard(block_id)
+                        self._unlink(block)
+            self._drive_write_blocks(start, buffers)
+            self.drive.sync()
+        finally:
+            for latch in reversed(latches):
+                latch.release()
+
+    def _write_out(self, block):
+        self._drive_write(block)
+        self._count('cache_write_backs')
+        block.dirty = False
+        self.dirty.discard(block.block_id)
+
+    def _written(self, block_id):
+        """Note write of block for reads of it from drive which are in progress, their data are stale"""
+        version = self.versions.get(block_id)
+        if version is not None:
+            version[1] += 1
+
+    def _begin_reads(self, block_ids):
+        """Register reads of blocks from drive, return block_id -> number of its writes to compare after read"""
+        writes = {}
+        for block_id in block_ids:
+            version = self.versions.get(block_id)
+            if version is None:
+                version = self.versions[block_id] = [0, 0]
+            version[0] += 1
+            writes[block_id] = version[1]
+        return writes
+
+    def _end_reads(self, block_ids):
+        for block_id in block_ids:
+            version = self.versions[block_id]
+            version[0] -= 1
+            if version[0] == 0:
+                del self.versions[block_id]
+
+    def _touch(self, block):
+        """Give block second chance, prefetched block stays cold after its first use"""
+        if block.prefetched:
+            block.prefetched = False
+            self.read_ahead.prefetch_hit()
+            return
+        block.ready_to_delete = False
+
+    def read(self, block_id, read_ahead=True):
+        """Read block from cache, if it is not there then read from virtual drive"""
+        with self.lock:
+            block = self.blocks.get(block_id)
+            if block is not None:
+                self._touch(block)
+                self._count('cache_hits', block_id)
+
+        if block is None:
+            # only one thread reads the block from drive, others wait for it on latch
+            with self._latch(block_id):
+                with self.lock:
+                    block = self.blocks.get(block_id)
+                if block is None:
+                    self._count('cache_misses', block_id)
+                    data = self._drive_read(block_id)
+                    with self.lock:
+                        block = self.blocks.get(block_id)
+                        if block is None:
+                            block = self._insert(Block(block_id, False, data))
+
+        self._read_ahead(block_id, 1, read_ahead)
+        return block
+
+    def read_blocks(self, start, count, read_ahead=True):
+        """
+        Return list of count consecutive blocks
+        Blocks which are not in cache are read from virtual drive, consecutive ones with one call
+        """
+        with self.lock:
+            blocks = [self.blocks.get(block_id) for block_id in range(start, start + count)]
+            for block in blocks:
+                if block is not None:
+                    self._touch(block)
+                    self._count('cache_hits', block.block_id)
+            writes = self._begin_reads([start + idx for idx, block in enumerate(blocks) if block is None])
+
+        stale = []
+        idx = 0
+        try:
+            while idx < count:
+                if blocks[idx] is not None:
+                    idx += 1
+                    continue
+                # find run of blocks which are missing in cache, it is read without holding the lock
+                miss_end = idx + 1
+                while miss_end < count and blocks[miss_end] is None:
+                    miss_end += 1
+                data = memoryview(self._drive_read_blocks(start + idx, miss_end - idx))
+                with self.lock:
+                    for position in range(idx, miss_end):
+                        block_id = start + position
+                        block = self.blocks.get(block_id)
+                        if block is None and self.versions[block_id][1] != writes[block_id]:
+                            # block was written meanwhile, read it again with its latch
+                            stale.append(position)
+                            continue
+                        if block is None:
+                            self._count('cache_misses', block_id)
+                            offset = (position - idx) * BLOCK_SIZE
+                            block = self._insert(Block(block_id, False, data[offset:offset + BLOCK_SIZE]))
+                        blocks[position] = block
+                idx = miss_end
+        finally:
+            with self.lock:
+                self._end_reads(writes)
+
+        for position in stale:
+            blocks[position] = self.read(start + position, False)
+
+        self._read_ahead(start, count, read_ahead)
+        return blocks
+
+    def _read_ahead(self, start, count, read_ahead):
+        if not read_ahead or self.read_ahead is None:
+            return
+        with self.lock:
+            skip, prefetch_count = self.read_ahead.access(start, count)
+        self.prefetch(start + count + skip, prefetch_count)
+
+    def prefetch(self, start, count):
+        """
+        Read count blocks from start which are not in cache as cold blocks
+        At most half of the cache is used for one prefetch, blocks behind the end of drive are skipped
+        """
+        if count <= 0:
+            return
+        end = min(start + min(count, self.capacity // 2), self.drive.number_of_blocks)
+        idx = max(start, 0)
+        while idx < end:
+            with self.lock:
+                if idx in self.blocks:
+                    idx += 1
+                    continue
+                miss_end = idx + 1
+                while miss_end < end and miss_end not in self.blocks:
+                    miss_end += 1
+                writes = self._begin_reads(range(idx, miss_end))
+
+            try:
+                data = memoryview(self._drive_read_blocks(idx, miss_end - idx))
+                with self.lock:
+                    for position in range(0, len(data), BLOCK_SIZE):
+                        # skip blocks which were read or written meanwhile
+                        if idx not in self.blocks and self.versions[idx][1] == writes[idx]:
+                            block = Block(idx, True, data[position:position + BLOCK_SIZE])
+                            block.prefetched = True
+                            self._insert(block)
+                            self._count('cache_prefetched', idx)
+                        idx += 1
+            finally:
+                with self.lock:
+                    self._end_reads(writes)
+
+    def _insert(self, block):
+        """Put new block to cache as the newest one in the ring"""
         if self.is_full():
             self.create_space()
 
-        if self.is_in_cache(block_id):
-            self.remove_from_cache(new_block)
+        if self.hand is None:
+            block.prev = block.next = block
+            self.hand = block
+        else:
+            # newest block sits right behind the hand, so it is checked last
+            block.next = self.hand
+            block.prev = self.hand.prev
+            self.hand.prev.next = block
+            self.hand.prev = block
 
-        self.queue.appendleft(new_block)
-        self.drive.write(new_block)
+        self.blocks[block.block_id] = block
+        return block
 
-    def read(self, block_id):
-        """Read block from cache, if it is not there then read from virtual drive"""
-        if 0 <= block_id < self.capacity and self.is_in_cache(block_id):
-            index = self.queue.index(Block(block_id, False, False))
-            block = self.queue[index]
-            self.queue.remove(block)
-            block.ready_to_delete = False
-            self.queue.appendleft(block)
-            return block
-
-        new_block = Block(block_id, False, self.drive.read(block_id))
-        self.queue.appendleft(new_block)
-        return new_block
+    def _unlink(self, block):
+        """Remove block from ring and from index"""
+        del self.blocks[block.block_id]
+        if block.next is block:
+            self.hand = None
+        else:
+            block.prev.next = block.next
+            block.next.prev = block.prev
+            if self.hand is block:
+                self.hand = block.next
+        block.prev = block.next = None
 
     def is_empty(self):
-        return len(self.queue) == 0
+        return len(self.blocks) == 0
 
     def is_full(self):
-        return len(self.queue) == self.capacity
+        return len(self.blocks) >= self.capacity
 
     def is_in_cache(self, block_id):
-        return self.queue.count(Block(block_id)) == 1
+        return block_id in self.blocks
 
     def create_space(self):
         """Second chance - Create empty space for block in cache"""
         while True:
-            candidate = self.queue.pop()
+            candidate = self.hand
             if candidate.ready_to_delete:
-                return
+                if candidate.dirty:
+                    self._write_out_neighbours(candidate)
+                if candidate.prefetched:
+                    self.read_ahead.prefetch_wasted()
+                self._unlink(candidate)
+                self._count('cache_evictions', candidate.block_id)
+                return candidate
+            # block was used since the hand passed it, it gets second chance
+            self._count('cache_second_chances', candidate.block_id)
             candidate.ready_to_delete = True
-            self.queue.appendleft(candidate)
+            self.hand = candidate.next
+
+    def _write_out_neighbours(self, block):
+        """Write dirty block together with run of consecutive dirty blocks around it with one call"""
+        first = last = block.block_id
+        while first - 1 in self.dirty:
+            first -= 1
+        while last + 1 in self.dirty:
+            last += 1
+        self._write_out_dirty(range(first, last + 1))
 
     def remove_from_cache(self, block_id):
-        self.queue.remove(block_id)
+        if isinstance(block_id, Block):
+            block_id = block_id.block_id
+        with self.lock:
+            block = self.blocks.get(block_id)
+            if block is not None:
+                if block.dirty:
+                    self._write_out(block)
+                self._unlink(block)
+
+    def discard(self, start, count):
+        """Drop count consecutive blocks from cache without writing them and set them to zeros on drive"""
+        # consecutive blocks use every latch at most once in the first LATCHES blocks
+        latches = self._latches(range(start, start + min(count, len(self.latches))))
+        for latch in latches:
+            latch.acquire()
+        try:
+            with self.lock:
+                block_ids = range(start, start + count)
+                if len(self.blocks) < count:
+                    block_ids = [block_id for block_id in self.blocks if start <= block_id < start + count]
+                for block_id in block_ids:
+                    self._written(block_id)
+                    block = self.blocks.get(block_id)
+                    if block is not None:
+                        block.dirty = False
+                        self.dirty.discard(block_id)
+                        self._unlink(block)
+            self.drive.discard(start, count)
+            self._count('drive_discarded_blocks', value=count)
+        finally:
+            for latch in reversed(latches):
+                latch.release()
 
     def clear_cache(self):
-        self.queue.clear()
+        self.flush()
+        with self.lock:
+            # blocks which were written after flush
+            self._write_out_dirty(self.dirty)
+            for block in self.blocks.values():
+                block.prev = block.next = None
+            self.blocks.clear()
+            self.hand = None
 
     def show_cache(self):
-        return self.queue
+        """Return blocks in ring order, from the next eviction candidate to the newest one"""
+        with self.lock:
+            blocks = []
+            block = self.hand
+            for _ in range(len(self.blocks)):
+                blocks.append(block)
+                block = block.next
+            return blocks
 
     def drv_stat(self):
         """Return size of virtual drive"""
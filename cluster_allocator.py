@@ -0,0 +1,116 @@
+class ClusterAllocator:
+    """
+    Allocator of empty clusters in FAT
+    Keeps bitmap of empty clusters, their count and list of free extents (runs of consecutive empty clusters)
+    """
+    def __init__(self, fat, empty_cluster):
+        self.bitmap = bytearray(1 if value == empty_cluster else 0 for value in fat)
+        self.extents = {}       # first cluster of free extent -> its length
+        self.extent_ends = {}   # cluster after free extent -> first cluster of extent
+        self.free_count = 0
+
+        start = None
+        for cluster_id, free in enumerate(self.bitmap):
+            if free and start is None:
+                start = cluster_id
+            elif not free and start is not None:
+                self._add_extent(start, cluster_id - start)
+                start = None
+        if start is not None:
+            self._add_extent(start, len(self.bitmap) - start)
+
+    def __repr__(self):
+        return f"ClusterAllocator(free_count: {self.free_count}, extents: {len(self.extents)})"
+
+    def _add_extent(self, start, length):
+        self.extents[start] = length
+        self.extent_ends[start + length] = start
+        self.free_count += length
+
+    def _remove_extent(self, start):
+        length = self.extents.pop(start)
+        del self.extent_ends[start + length]
+        self.free_count -= length
+        return length
+
+    def is_free(self, cluster_id):
+        return self.bitmap[cluster_id] == 1
+
+    def first_free(self):
+        """Return empty cluster with the lowest id"""
+        if not self.extents:
+            return None
+        return min(self.extents)
+
+    def free_clusters(self):
+        """Return ids of all empty clusters"""
+        clusters = []
+        for start in sorted(self.extents):
+            clusters.extend(range(start, start + self.extents[start]))
+        return clusters
+
+    def _take(self, start, count):
+        """Use count clusters from beginning of free extent"""
+        length = self._remove_extent(start)
+        count = min(count, length)
+        if length > count:
+            self._add_extent(start + count, length - count)
+        self.bitmap[start:start + count] = bytes(count)
+        return list(range(start, start + count))
+
+    def _best_fit(self, count):
+        """Return start of the smallest extent with at least count clusters, or of the largest one"""
+        best = None
+        largest = None
+        for start, length in self.extents.items():
+            if length >= count and (best is None or length < self.extents[best]):
+                best = start
+                if length == count:
+                    break
+            if largest is None or length > self.extents[largest]:
+                largest = start
+        return best if best is not None else largest
+
+    def allocate(self, count, hint=None):
+        """
+        Mark count empty clusters as used and return them, runs of consecutive clusters are preferred
+        If hint is beginning of free extent (cluster after the end of file), clusters continue from there
+        Return None if there is not enough empty clusters
+        """
+        if count > self.free_count:
+            return None
+
+        clusters = []
+        if hint is not None and hint in self.extents:
+            clusters += self._take(hint, count)
+        while len(clusters) < count:
+            clusters += self._take(self._best_fit(count - len(clusters)), count - len(clusters))
+        return clusters
+
+    def claim(self, cluster_id):
+        """Mark one empty cluster as used"""
+        if not self.is_free(cluster_id):
+            return
+        start = cluster_id
+        while start > 0 and self.bitmap[start - 1]:
+            start -= 1
+        length = self._remove_extent(start)
+        if cluster_id > start:
+            self._add_extent(start, cluster_id - start)
+        if start + length > cluster_id + 1:
+            self._add_extent(cluster_id + 1, start + length - cluster_id - 1)
+        self.bitmap[cluster_id] = 0
+
+    def release(self, cluster_id):
+        """Mark cluster as empty and merge it with neighbouring free extents"""
+        if self.is_free(cluster_id):
+            return
+        self.bitmap[cluster_id] = 1
+        start = cluster_id
+        length = 1
+        if cluster_id in self.extent_ends:
+            start = self.extent_ends[cluster_id]
+            length += self._remove_extent(start)
+        if cluster_id + 1 in self.extents:
+            length += self._remove_extent(cluster_id + 1)
+        self._add_extent(start, length)
@@ -1,18 +1,46 @@
-import struct
-from math import ceil, floor
+import threading
+from contextlib import contextmanager
+from math import ceil
 
+import bulk
+import fsck
 from cache import Cache
+from cluster_allocator import ClusterAllocator
 from constants import *
+from journal import Journal, record_blocks
+from layout import Layout
+from root_dir_index import RootDirIndex
+from virtual_drive import ZERO_BLOCKS_PER_WRITE
 
 
 class Fat8:
-    """FAT8 - file system"""
+    """
+    FAT8 - file system
+    Geometry of file system on drive is described by layout, version 1 is the original one,
+    version 2 has multi-block FAT with wide entries and chosen cluster size
+    With journal (version 2) changes of FAT and root directory go to drive by group commit of journal
+    """
     def __init__(self):
         self.cache = None                   # virtual drive
+        self.layout = None                  # geometry of file system on drive (version 1 or 2)
+        self.cluster_count = None           # number of clusters (entries of FAT)
+        self.empty_cluster = None           # value of FAT entry of empty cluster
+        self.eoc_cluster = None             # value of FAT entry of the last cluster of chain
         self.blocks_per_clust = None        # number of blocks in one cluter
         self.root_directory_blocks = None   # number of blocks in root directory
         self.data_blocks = None             # number of blocks which can be used
         self.size = None                    # size of file system
+        self.fat = None                     # FAT table loaded in memory
+        self.fat_dirty = set()              # indexes of FAT blocks which differ from FAT on virtual drive
+        self.allocator = None               # empty clusters of FAT
+        self.root_dir = None                # root directory index
+        self.journal = None                 # journal of metadata blocks or None
+        self.chains = {}                    # first cluster -> cluster chain of file shared by its descriptors
+        self.new_clusters = set()           # allocated clusters which were not written yet, their data are zeros
+        # FAT with allocator and root directory can be changed from more threads, FAT lock is taken first
+        self.fat_lock = threading.RLock()
+        self.dir_lock = threading.RLock()
+        self._transaction_depth = 0         # number of nested metadata transactions
 
     def __repr__(self):
         return (f"Fat8: (blocks_per_clust: {self.blocks_per_clust}, root_directory_blocks: {self.root_directory_blocks}, "
@@ -21,94 +49,208 @@ class Fat8:
     def __str__(self):
         return self.__repr__()
 
-    @staticmethod
-    def _empty_fat():
-        fat = bytearray([0xff] * 254)
-        return fat.ljust(BLOCK_SIZE, b'\0')
-
     @staticmethod
     def _empty_block():
         return bytearray([0x00] * BLOCK_SIZE)
 
-    @staticmethod
-    def _root_directory_blocks():
-        return ceil(DIR_ENTRY_SIZE * FAT_MAX_CLUSTERS / BLOCK_SIZE)
-
-    @staticmethod
-    def first_root_directory_block():
-        return BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE
-
-    def _data_blocks_size(self):
-        """Return number of all blocks for data"""
-        return self.cache.drive.number_of_blocks - self.root_directory_blocks - BOOT_BLOCK_SIZE - FAT_BLOCK_SIZE
-
-    def _blocks_per_cluster(self):
-        return floor(self._data_blocks_size() / FAT_MAX_CLUSTERS)
+    def _set_layout(self, layout):
+        self.layout = layout
+        self.blocks_per_clust = layout.blocks_per_clust
+        self.root_directory_blocks = layout.root_directory_blocks
+        self.data_blocks = layout.data_blocks
+        self.size = self.fs_size()
+        self.cluster_count = layout.cluster_count
+        self.empty_cluster = layout.empty_cluster
+        self.eoc_cluster = layout.eoc_cluster
 
-    def _actual_data_block_size(self):
-        """Return number of blocks remaining for the data"""
-        return self._blocks_per_cluster() * FAT_MAX_CLUSTERS
+    def first_root_directory_block(self):
+        return self.layout.first_root_directory_block()
 
     def _first_data_block(self):
-        return (BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE + self.root_directory_blocks) * self.blocks_per_clust
+        return self.layout.first_data_block()
 
     def _convert_boot_block_to_bin(self):
-        """
-        Return boot block in binary
-        1 byte - blocks per cluter, 4 byty - size of file system
-        4 byty - size of root directory, 4 byty - size of data blocks
-        """
-        return struct.pack(f'BIII', self.blocks_per_clust, self.size, self.root_directory_blocks, self.data_blocks)
+        """Return boot block in binary, its content depends on version of layout"""
+        return self.layout.boot_block()
 
     def _read_boot_block(self):
-        boot_block = self.cache.read(0)
-        return boot_block.data[:STRUCT_BUFFER]
+        boot_block = self.cache.read(0, False)
+        return boot_block.data
 
     def _load_boot_block_from_bin(self):
-        boot_block_data = self._read_boot_block()
-        self.blocks_per_clust, self.size, self.root_directory_blocks, self.data_blocks = struct.unpack(f'BIII', boot_block_data)
+        self._set_layout(Layout.from_boot_block(self._read_boot_block()))
 
     def _write_boot_block(self, data):
         """Write boot block to virtual drive"""
         self.cache.write(0, data)
 
     def _read_fat_block(self):
-        """Read fat block from virtual drive from binary data"""
-        fat_block = self.cache.read(1)
-        fat_block_data = fat_block.data[:FAT_MAX_CLUSTERS]
-        return bytearray(fat_block_data)
-
-    def _write_fat_block(self, data):
-        """Write fat block to virtual drive"""
-        self.cache.write(1, data)
+        """Read all FAT blocks from virtual drive and return FAT table"""
+        fat_blocks = self.cache.read_blocks(BOOT_BLOCK_SIZE, self.layout.fat_blocks, False)
+        return self.layout.fat_from_bytes(b''.join(bytes(block.data) for block in fat_blocks))
+
+    def _write_fat_blocks(self, first_block, count):
+        """Write count blocks of FAT table from first_block (index in FAT) to virtual drive"""
+        data = memoryview(self.layout.fat_to_bytes(self.fat, first_block, count))
+        self.write_metadata_blocks(BOOT_BLOCK_SIZE + first_block,
+                                   [data[idx * BLOCK_SIZE:(idx + 1) * BLOCK_SIZE].tobytes() for idx in range(count)])
+
+    def read_metadata_block(self, block_id):
+        """Return data of FAT or root directory block, changes which are not checkpointed are taken from journal"""
+        if self.journal is not None:
+            data = self.journal.block(block_id)
+            if data is not None:
+                return data
+        return self.cache.read(block_id, False).data
+
+    def write_metadata_blocks(self, block_id, buffers):
+        """
+        Write consecutive FAT or root directory blocks to virtual drive
+        With journal they become part of transaction and go to drive when its group is committed
+        """
+        if self.journal is None:
+            if len(buffers) == 1:
+                self.cache.write(block_id, buffers[0])
+            else:
+                self.cache.write_blocks(block_id, buffers)
+            return
+        with self.transaction():
+            for idx, data in enumerate(buffers):
+                self.journal.stage(block_id + idx, data)
+
+    def _empty_journal(self):
+        """Write empty journal, so there is no record to replay"""
+        if self.layout.journal_blocks:
+            self.cache.write_blocks(self.layout.first_journal_block(), [bytes(BLOCK_SIZE)] * self.layout.journal_blocks)
+
+    def _open_journal(self):
+        """Create journal if layout has one and replay its last record"""
+        self.journal = None
+        if self.layout.journal_blocks:
+            if record_blocks(self.layout.fat_blocks + self.root_directory_blocks) > self.layout.journal_blocks:
+                raise ValueError("Journal of file system is too small for all FAT and root directory blocks")
+            self.journal = Journal(self.cache, self.layout.first_journal_block(), self.layout.journal_blocks)
+            self.journal.replay()
 
     def _empty_root_block(self):
-        root_block_id_start = BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE
-        for block_id in range(root_block_id_start, root_block_id_start + self.root_directory_blocks):
-            self.cache.write(block_id, self._empty_block())
+        """Write empty root directory with one call"""
+        root_block_id_start = self.first_root_directory_block()
+        empty_block = bytes(BLOCK_SIZE)
+        self.cache.write_blocks(root_block_id_start, [empty_block] * self.root_directory_blocks)
 
-    def _empty_data_block(self):
-        data_block_id_start = BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE + self.root_directory_blocks
-        for block_id in range(data_block_id_start, data_block_id_start + self.data_blocks):
-            self.cache.write(block_id, self._empty_block())
+    def _empty_data_block(self, quick=False):
+        """
+        Set data blocks to zeros, they are written in batches of ZERO_BLOCKS_PER_WRITE blocks
+        With quick they are only discarded on drive (hole is punched to backing file if it is possible)
+        """
+        data_block_id_start = self._first_data_block()
+        if quick:
+            self.cache.discard(data_block_id_start, self.data_blocks)
+            return
+
+        empty_block = bytes(BLOCK_SIZE)
+        data_block_id_end = data_block_id_start + self.data_blocks
+        for block_id in range(data_block_id_start, data_block_id_end, ZERO_BLOCKS_PER_WRITE):
+            count = min(ZERO_BLOCKS_PER_WRITE, data_block_id_end - block_id)
+            self.cache.write_blocks(block_id, [empty_block] * count)
+
+    def _load_fat(self):
+        """Load FAT table from virtual drive to memory"""
+        self.fat = self._read_fat_block()
+        self.fat_dirty = set()
+        self.chains = {}
+        self.new_clusters = set()
+        self.allocator = ClusterAllocator(self.fat, self.empty_cluster)
+
+    def _write_back_fat(self):
+        """Write changed blocks of FAT table from memory to virtual drive, consecutive blocks with one call"""
+        if not self.fat_dirty:
+            return
+        run_start = None
+        run_count = 0
+        for block in sorted(self.fat_dirty):
+            if run_count and run_start + run_count == block:
+                run_count += 1
+                continue
+            if run_count:
+                self._write_fat_blocks(run_start, run_count)
+            run_start, run_count = block, 1
+        self._write_fat_blocks(run_start, run_count)
+        self.fat_dirty = set()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Group metadata changes, FAT table is written to virtual drive once at the end of the outermost transaction
+        Without transaction every change of FAT is written immediately
+        Transaction holds FAT lock, so metadata changes of other threads wait for its end
+        With journal the end of the outermost transaction adds it to group of journal
+        """
+        with self.fat_lock:
+            self._transaction_depth += 1
+            try:
+                yield self
+            finally:
+                try:
+                    if self._transaction_depth == 1:
+                        self._write_back_fat()
+                        if self.journal is not None:
+                            self.journal.end_transaction()
+                finally:
+                    self._transaction_depth -= 1
 
     def get_empty_cluster(self):
         """Return empty cluster in FAT table"""
-        fat_block = self._read_fat_block()
-        if EMPTY_CLUSTER in fat_block:
-            return fat_block.index(EMPTY_CLUSTER)
-        return None
+        with self.fat_lock:
+            return self.allocator.first_free()
 
     def get_empty_clusters(self):
         """Return all empty clusters in FAT table"""
-        fat_block = self._read_fat_block()
-        if EMPTY_CLUSTER in fat_block:
-            return [idx for idx, el in enumerate(fat_block) if el == EMPTY_CLUSTER]
-        return None
+        with self.fat_lock:
+            if self.allocator.free_count == 0:
+                return None
+            return self.allocator.free_clusters()
+
+    def free_clusters_count(self):
+        return self.allocator.free_count
+
+    def reclaim_clusters(self, count):
+        """
+        Return True if there are at least count empty clusters
+        With journal clusters freed by finished transactions are empty when their group is committed,
+        so the group is committed if clusters are missing and it frees some
+        """
+        with self.fat_lock:
+            if self.allocator.free_count < count and self.journal is not None and self.journal.pending_deferred:
+                self.journal.commit()
+            return self.allocator.free_count >= count
+
+    def allocate_clusters(self, count, hint=None):
+        """
+        Allocate count empty clusters, link them to chain ended with EOC and return them
+        Runs of consecutive clusters are preferred, allocation starts at hint if it is empty
+        Return None if there is not enough empty clusters
+        """
+        with self.transaction():
+            if not self.reclaim_clusters(count):
+                return None
+            clusters = self.allocator.allocate(count, hint)
+            if clusters is None:
+                return None
+
+            for cluster_id, next_cluster_id in zip(clusters, clusters[1:]):
+                self.write_value_to_cluster(cluster_id, next_cluster_id)
+            self.write_value_to_cluster(clusters[-1], self.eoc_cluster)
+            self.new_clusters.update(clusters)
+        return clusters
+
+    def is_new_cluster(self, cluster_id):
+        """Return True if cluster was allocated and nothing was written to it since, so it does not have to be read"""
+        return cluster_id in self.new_clusters
 
     def get_next_cluster(self, cluster_id):
         """Return cluster_id of next cluster"""
-        return self._read_fat_block()[cluster_id]
+        return self.fat[cluster_id]
 
     def get_last_cluster(self, first_cluster):
         """Return last cluster of virtual drive"""
@@ -121,77 +263,273 @@ class Fat8:
         current_cluster_id = first_cluster
         next_cluster = self.get_next_cluster(current_cluster_id)
 
-        while next_cluster != EOC_CLUSTER:
+        while next_cluster != self.eoc_cluster:
             current_cluster_id = next_cluster
             clusters += [next_cluster]
             next_cluster = self.get_next_cluster(current_cluster_id)
 
         return clusters
 
+    def file_chain(self, first_cluster):
+        """
+        Return cluster chain of file, FAT is walked only once and all descriptors of file share the chain,
+        so changes of its length by one descriptor are seen by the others
+        """
+        with self.fat_lock:
+            chain = self.chains.get(first_cluster)
+            if chain is None:
+                chain = self.chains[first_cluster] = self.get_file_clusters(first_cluster)
+            return chain
+
+    def forget_chains(self, first_cluster=None):
+        """Forget shared chain of file starting at first_cluster (all chains if it is None)"""
+        with self.fat_lock:
+            if first_cluster is None:
+                self.chains = {}
+            else:
+                self.chains.pop(first_cluster, None)
+
     def write_value_to_cluster(self, cluster_id, value):
         """Write value to cluster in FAT"""
-        fat_block = self._read_fat_block()
-        fat_block[cluster_id] = value
-        self._write_fat_block(fat_block)
+        with self.fat_lock:
+            if value == self.empty_cluster and self.journal is not None:
+                # cluster can be allocated again when its release is durable
+                self.journal.defer(self._release_cluster, cluster_id)
+            elif value == self.empty_cluster:
+                self.allocator.release(cluster_id)
+            else:
+                self.allocator.claim(cluster_id)
+            self.fat[cluster_id] = value
+            self.fat_dirty.add(self.layout.fat_block_of_cluster(cluster_id))
+            if self._transaction_depth == 0:
+                self._write_back_fat()
+
+    def free_clusters(self, clusters, wipe=False):
+        """
+        Mark clusters empty in FAT, their data are cleared before they can be allocated again,
+        so new clusters of files are always zero (see data_clusters_clear)
+        """
+        with self.transaction():
+            if self.journal is None:
+                self.data_clusters_clear(clusters, wipe)
+            else:
+                # with journal clusters keep their data until the change of FAT is durable
+                self.journal.defer(self.data_clusters_clear, clusters, wipe)
+            for cluster_id in clusters:
+                self.write_value_to_cluster(cluster_id, self.empty_cluster)
+            self.new_clusters.difference_update(clusters)
+
+    def _release_cluster(self, cluster_id):
+        """Return cluster to allocator if it is still empty in FAT"""
+        if self.fat[cluster_id] == self.empty_cluster:
+            self.allocator.release(cluster_id)
 
     def write_next_cluster_to_cluster(self, cluster_id, new_clusted_id):
         """Write value of next cluster to current cluster"""
-        if not 0 <= new_clusted_id <= FAT_MAX_CLUSTERS:
+        if not (0 <= new_clusted_id < self.cluster_count or new_clusted_id == self.eoc_cluster):
             raise ValueError("Not valid new cluster id")
         self.write_value_to_cluster(cluster_id, new_clusted_id)
 
+    def data_block_readinto(self, block_id, count, buffer, read_ahead=True):
+        """Copy count blocks straight from cache to writable buffer (bytearray/memoryview)"""
+        view = memoryview(buffer)
+        position = 0
+        for block in self.cache.read_blocks(block_id, count, read_ahead):
+            view[position:position + len(block.data)] = block.data
+            position += BLOCK_SIZE
+
     def data_block_read(self, block_id, count):
-        data = bytearray()
-        for idx in range(block_id, block_id + count):
-            block = self.cache.read(idx)
-            data.extend(block.data)
+        data = bytearray(count * BLOCK_SIZE)
+        self.data_block_readinto(block_id, count, data)
         return data
 
-    def data_cluster_read(self, cluster_id):
+    def data_cluster_block(self, cluster_id):
+        """Return id of the first block of cluster"""
+        return (cluster_id * self.blocks_per_clust) + self._first_data_block()
+
+    def _read_ahead_chain(self, cluster_id):
+        """Report read of cluster to read ahead of cache and prefetch next clusters of its chain"""
+        read_ahead = self.cache.read_ahead
+        next_cluster_id = self.fat[cluster_id]
+        if read_ahead is None or next_cluster_id >= self.cluster_count:
+            return
+
+        with self.cache.lock:
+            skip, window = read_ahead.access(self.data_cluster_block(cluster_id), self.blocks_per_clust,
+                                             self.data_cluster_block(next_cluster_id))
+        window = min(window, self.cache.capacity // 2)
+        # skip clusters of chain which are already prefetched
+        while window > 0 and skip > 0 and next_cluster_id < self.cluster_count:
+            skip -= self.blocks_per_clust
+            next_cluster_id = self.fat[next_cluster_id]
+        # prefetch following clusters of chain, consecutive clusters together
+        start = count = None
+        while window > 0 and next_cluster_id < self.cluster_count:
+            block_id = self.data_cluster_block(next_cluster_id)
+            if count is not None and start + count == block_id:
+                count += self.blocks_per_clust
+            else:
+                if count is not None:
+                    self.cache.prefetch(start, count)
+                start, count = block_id, self.blocks_per_clust
+            window -= self.blocks_per_clust
+            next_cluster_id = self.fat[next_cluster_id]
+        if count is not None:
+            self.cache.prefetch(start, count)
+
+    def data_cluster_readinto(self, cluster_id, buffer):
         offset_block_id = (cluster_id * self.blocks_per_clust) + self._first_data_block()
-        return self.data_block_read(offset_block_id, self.blocks_per_clust)
+        self.data_block_readinto(offset_block_id, self.blocks_per_clust, buffer, False)
+        self._read_ahead_chain(cluster_id)
+
+    def data_cluster_read(self, cluster_id):
+        data = bytearray(self.blocks_per_clust * BLOCK_SIZE)
+        self.data_cluster_readinto(cluster_id, data)
+        return data
+
+    def data_blocks_write(self, block_id, buffers):
+        """Write list of buffers (one for each block) to consecutive blocks with one call"""
+        if self.new_clusters:
+            first_cluster = (block_id - self._first_data_block()) // self.blocks_per_clust
+            last_cluster = (block_id + len(buffers) - 1 - self._first_data_block()) // self.blocks_per_clust
+            self.new_clusters.difference_update(range(first_cluster, last_cluster + 1))
+        self.cache.write_blocks(block_id, [bytes(buffer) for buffer in buffers])
 
     def data_block_write(self, block_id, count, data):
-        data_index_start = 0
-        data_index_end = BLOCK_SIZE
-        for idx in range(block_id, block_id + count):
-            self.cache.write(idx, data[data_index_start:data_index_end])
-            data_index_start += data_index_end
-            data_index_end += BLOCK_SIZE
+        """Write data to count consecutive blocks with one call, blocks without data are skipped"""
+        count = min(count, ceil(len(data) / BLOCK_SIZE))
+        view = memoryview(data)
+        self.data_blocks_write(block_id, [view[idx * BLOCK_SIZE:(idx + 1) * BLOCK_SIZE] for idx in range(count)])
 
     def data_cluster_write(self, cluster_id, data):
         offset_block_id = (cluster_id * self.blocks_per_clust) + self._first_data_block()
         return self.data_block_write(offset_block_id, self.blocks_per_clust, data)
 
+    def data_clusters_clear(self, clusters, wipe=False):
+        """
+        Set data of clusters to zeros, consecutive clusters with one call
+        Blocks are discarded on drive, wipe overwrites them by zeros instead
+        """
+        runs = []
+        for cluster_id in sorted(clusters):
+            if runs and runs[-1][0] + runs[-1][1] == cluster_id:
+                runs[-1][1] += 1
+            else:
+                runs.append([cluster_id, 1])
+
+        for cluster_id, count in runs:
+            block_id = self.data_cluster_block(cluster_id)
+            blocks = count * self.blocks_per_clust
+            if wipe:
+                self.data_block_write(block_id, blocks, bytes(blocks * BLOCK_SIZE))
+            else:
+                self.cache.discard(block_id, blocks)
+
     def fs_size_blocks(self):
-        return BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE + self._root_directory_blocks() + self.data_blocks
+        return self.layout.fs_size_blocks()
 
     def fs_size(self):
         return self.fs_size_blocks() * BLOCK_SIZE
 
-    def format(self, drive):
+    def format(self, drive, quick=False, version=1, blocks_per_cluster=None, fat_entry_size=None,
+               root_entries=None, journal_blocks=None):
+        """
+        Create empty file system on drive
+        quick - data blocks are not overwritten, they are discarded on drive, so time does not depend on its size
+        version - 1 is the original FAT8 with 254 clusters, cluster size is given by size of drive
+        version 2 has cluster size blocks_per_cluster, 2 or 4 byte FAT entries (fat_entry_size, chosen
+        by number of clusters by default), root directory with root_entries entries
+        and journal of metadata with journal_blocks blocks (0 is file system without journal)
+        """
         if not isinstance(drive, Cache):
             raise TypeError("Choosed drive is not instance of Cache")
         self.cache = drive
-
-        self.root_directory_blocks = self._root_directory_blocks()
-        self.blocks_per_clust = self._blocks_per_cluster()
-        self.data_blocks = self._actual_data_block_size()
-        self.size = self.fs_size()
+        self.journal = None
+
+        if version == 1:
+            if blocks_per_cluster is not None or fat_entry_size is not None or root_entries is not None or \
+                    journal_blocks is not None:
+                raise ValueError("Geometry of file system can be chosen only in version 2")
+            self._set_layout(Layout.v1(drive.drive.number_of_blocks))
+        elif version == 2:
+            self._set_layout(Layout.v2(drive.drive.number_of_blocks, blocks_per_cluster, fat_entry_size, root_entries,
+                                       journal_blocks))
+        else:
+            raise ValueError(f"Not supported version {version} of file system")
+        self._set_block_classes()
 
         # write boot block to virtual drive
         self._write_boot_block(self._convert_boot_block_to_bin())
-        # set FAT block
-        self._write_fat_block(self._empty_fat())
+        # set FAT blocks
+        self.fat = self.layout.empty_fat()
+        self._write_fat_blocks(0, self.layout.fat_blocks)
+        self._load_fat()
         # empty rest of virtual drive
         self._empty_root_block()
-        self._empty_data_block()
+        self._empty_journal()
+        self._empty_data_block(quick)
         # clear cache
         self.cache.clear_cache()
+        self._open_journal()
+        self.root_dir = RootDirIndex.build(self)
 
-    def open(self, drive):
+    def open(self, drive, check=False, repair=False):
+        """
+        Open file system on drive
+        check - check consistency with fsck and raise ValueError if there are problems
+        repair - check consistency and fix found problems, FsckReport is returned if file system is checked
+        """
         self.cache = drive
+        self._set_block_classes()
         self._load_boot_block_from_bin()
+        self._set_block_classes()
+        # metadata of interrupted group are finished before they are loaded
+        self._open_journal()
+        self._load_fat()
+        self.root_dir = RootDirIndex.build(self)
+
+        if not (check or repair):
+            return None
+        report = fsck.fsck(self, repair)
+        if not report.ok and not repair:
+            raise ValueError(f"File system is not consistent: {'; '.join(report.problems())}")
+        return report
+
+    def _set_block_classes(self):
+        """Tell stats of cache (if there are any) which blocks are boot, FAT and root directory"""
+        if self.cache.stats is None:
+            return
+        if self.layout is None:
+            self.cache.stats.set_block_classes([('boot', BOOT_BLOCK_SIZE)])
+            return
+        self.cache.stats.set_block_classes([('boot', BOOT_BLOCK_SIZE), ('fat', self.layout.fat_blocks),
+                                            ('root_dir', self.layout.root_directory_blocks),
+                                            ('journal', self.layout.journal_blocks)])
+
+    def flush(self):
+        """Write FAT table, commit group of journal and write all dirty blocks from cache to virtual drive"""
+        with self.fat_lock:
+            self._write_back_fat()
+            if self.journal is not None:
+                self.journal.commit()
+        self.cache.sync()
+
+    def close(self):
+        """Flush file system and release cache"""
+        if self.cache is None:
+            return
+        self.flush()
+        self.cache.clear_cache()
+        self.cache = None
+        self.journal = None
+
+    def import_tree(self, paths, workers=4):
+        """Copy host files (or files of host directories) to file system at once, see bulk.import_tree"""
+        return bulk.import_tree(self, paths, workers)
+
+    def export_all(self, dest, workers=4):
+        """Copy all files of file system to host directory dest, see bulk.export_all"""
+        return bulk.export_all(self, dest, workers)
 
     def show_cache(self):
         return self.cache.show_cache()
@@ -1,115 +1,366 @@
+import threading
+from collections import OrderedDict
+from functools import wraps
 from math import ceil
 
 from constants import *
+from fat_dir_entry import FatDirEntry
+from stats import timed
+
+
+def synchronized(method):
+    """Run method of FatFd under lock of descriptor"""
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked
 
 
 class FatFd:
-    """File decriptor for working with FatFile"""
-    def __init__(self, fs, fat_dir_entry):
+    """
+    File decriptor for working with FatFile
+    Clusters of file are loaded on demand to pages, page_window limits number of pages held by descriptor
+    (None - every page stays in memory once it is loaded)
+    """
+    def __init__(self, fs, fat_dir_entry, page_window=None):
+        if page_window is not None and page_window < 1:
+            raise ValueError("Page window has to hold at least one page")
         self.fs = fs
         self.fat_dir_entry = fat_dir_entry
         self.current_cluster = self.fat_dir_entry.fst_cluster_id
 
-        self.file_size = self.fat_dir_entry.size * self.fs.blocks_per_clust * BLOCK_SIZE  # size of file in bytes
+        self.cluster_size = self.fs.blocks_per_clust * BLOCK_SIZE      # size of cluster in bytes
         self.file_offset = 0     # current position in file = position
 
-        self.buffer = None       # buffer with loaded data
-        self._load_file_to_buffer()
-
-    def _load_file_to_buffer(self):
-        self.buffer = bytearray()
-        fst_cluster_id = self.fat_dir_entry.fst_cluster_id
-        clusters = self.fs.get_file_clusters(fst_cluster_id)
-        for cluster in clusters:
-            self.buffer.extend(self.fs.data_cluster_read(cluster))
-
-    def _write_buffer_to_drive(self):
-        if len(self.buffer) != self.file_size:
-            raise BufferError('Buffer is not same length as file, please update file length')
-        file_clusters = self.fs.get_file_clusters(self.fat_dir_entry.fst_cluster_id)
-        data_index_start = 0
-        data_index_end = BLOCK_SIZE * self.fs.blocks_per_clust
-        data = self.buffer
-        for cluster in file_clusters:
-            self.fs.data_cluster_write(cluster, data[data_index_start:data_index_end])
-            data_index_start += data_index_end
-            data_index_end += BLOCK_SIZE * self.fs.blocks_per_clust
+        self.page_window = page_window
+        self.pages = OrderedDict()   # index of cluster in file -> its data, the least recently used first
+        self.dirty_ranges = []   # (start, end) byte ranges of file which are not written to drive
+        self.lock = threading.RLock()   # descriptor can be shared by more threads
+
+    @property
+    def file_size(self):
+        """Size of file in bytes, entry of file is shared by its descriptors, so it is the same for all of them"""
+        return self.fat_dir_entry.size * self.cluster_size
+
+    def _file_clusters(self):
+        """Return cluster chain of file, it is cached in file system and shared by descriptors of file"""
+        return self.fs.file_chain(self.fat_dir_entry.fst_cluster_id)
+
+    def invalidate_clusters(self):
+        """Forget cached cluster chain, it is walked again on next access"""
+        self.fs.forget_chains(self.fat_dir_entry.fst_cluster_id)
+
+    def cluster_of_position(self, position):
+        """Return cluster in which byte on position is stored"""
+        clusters = self._file_clusters()
+        return clusters[min(position // self.cluster_size, len(clusters) - 1)]
+
+    def _page(self, index, load=True):
+        """Return page with data of cluster on index in file, cluster is read from cache if page is not loaded"""
+        page = self.pages.get(index)
+        if page is not None:
+            self.pages.move_to_end(index)
+            return page
+
+        if self.page_window is not None and len(self.pages) >= self.page_window:
+            self._evict_page()
+        page = bytearray(self.cluster_size)
+        cluster_id = self._file_clusters()[index]
+        # cluster which was not written since it was allocated is zero, so it is not read
+        if load and not self.fs.is_new_cluster(cluster_id):
+            self.fs.data_cluster_readinto(cluster_id, page)
+        self.pages[index] = page
+        return page
+
+    def _evict_page(self):
+        """Drop the least recently used page, dirty data are written to drive before"""
+        index = next(iter(self.pages))
+        if self._is_page_dirty(index):
+            self.flush()
+        del self.pages[index]
+
+    def _is_page_dirty(self, index):
+        page_start = index * self.cluster_size
+        page_end = page_start + self.cluster_size
+        return any(start < page_end and end > page_start for start, end in self.dirty_ranges)
+
+    def _read_bytes(self, position, size):
+        """Return size bytes of file from position, pages are loaded on demand"""
+        data = bytearray(size)
+        view = memoryview(data)
+        copied = 0
+        while copied < size:
+            index, offset = divmod(position + copied, self.cluster_size)
+            chunk = min(self.cluster_size - offset, size - copied)
+            page = memoryview(self._page(index))
+            view[copied:copied + chunk] = page[offset:offset + chunk]
+            copied += chunk
+        return data
+
+    def _write_bytes(self, position, data):
+        """Copy data to pages from position and mark them dirty, page is not read if it is overwritten whole"""
+        view = memoryview(data).cast('B')
+        written = 0
+        while written < len(view):
+            index, offset = divmod(position + written, self.cluster_size)
+            chunk = min(self.cluster_size - offset, len(view) - written)
+            page = self._page(index, load=chunk < self.cluster_size)
+            page[offset:offset + chunk] = view[written:written + chunk]
+            self._mark_dirty(position + written, position + written + chunk)
+            written += chunk
+
+    def _copy_out(self, position, view):
+        """
+        Copy bytes of file from position to view, loaded pages are used
+        Other clusters are read from cache straight to view without loading them to pages
+        """
+        copied = 0
+        while copied < len(view):
+            index, offset = divmod(position + copied, self.cluster_size)
+            chunk = min(self.cluster_size - offset, len(view) - copied)
+            page = self.pages.get(index)
+            if page is not None:
+                view[copied:copied + chunk] = memoryview(page)[offset:offset + chunk]
+            elif chunk == self.cluster_size:
+                self.fs.data_cluster_readinto(self._file_clusters()[index], view[copied:copied + chunk])
+            else:
+                # read only blocks in which requested part of cluster is
+                first_block = offset // BLOCK_SIZE
+                count = (offset + chunk - 1) // BLOCK_SIZE - first_block + 1
+                block_id = self.fs.data_cluster_block(self._file_clusters()[index]) + first_block
+                data = memoryview(self.fs.data_block_read(block_id, count))
+                start = offset - first_block * BLOCK_SIZE
+                view[copied:copied + chunk] = data[start:start + chunk]
+            copied += chunk
+
+    def _copy_in(self, position, data):
+        """
+        Write bytes to file from position, clusters which are not loaded go straight to cache
+        (only blocks touched by data), loaded pages are changed and their dirty blocks are flushed
+        """
+        view = memoryview(data).cast('B')
+        written = 0
+        while written < len(view):
+            index, offset = divmod(position + written, self.cluster_size)
+            chunk = min(self.cluster_size - offset, len(view) - written)
+            if index in self.pages:
+                self._write_bytes(position + written, view[written:written + chunk])
+            elif chunk == self.cluster_size:
+                self.fs.data_cluster_write(self._file_clusters()[index], view[written:written + chunk])
+            else:
+                self._write_part(index, offset, view[written:written + chunk])
+            written += chunk
+
+        self.flush()
+
+    def _write_part(self, index, offset, data):
+        """
+        Write data to part of cluster on index which is not loaded, only blocks touched by data are written
+        Blocks at the edges which data cover only partly are read before, unless cluster is new (zero)
+        """
+        cluster_id = self._file_clusters()[index]
+        first_block = offset // BLOCK_SIZE
+        count = (offset + len(data) - 1) // BLOCK_SIZE - first_block + 1
+        block_id = self.fs.data_cluster_block(cluster_id) + first_block
+        buffer = bytearray(count * BLOCK_SIZE)
+        start = offset - first_block * BLOCK_SIZE
+        end = start + len(data)
+        if not self.fs.is_new_cluster(cluster_id):
+            if start:
+                self.fs.data_block_readinto(block_id, 1, buffer, False)
+            if end % BLOCK_SIZE and (count > 1 or not start):
+                last = (count - 1) * BLOCK_SIZE
+                self.fs.data_block_readinto(block_id + count - 1, 1, memoryview(buffer)[last:], False)
+        buffer[start:end] = data
+        self.fs.data_block_write(block_id, count, buffer)
+
+    def _mark_dirty(self, start, end):
+        if end > start:
+            self.dirty_ranges.append((start, end))
+
+    def _dirty_blocks(self):
+        """Return sorted indexes of blocks of file which contain dirty bytes"""
+        blocks = set()
+        for start, end in self.dirty_ranges:
+            blocks.update(range(start // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1))
+        return sorted(blocks)
+
+    @synchronized
+    def flush(self):
+        """Write blocks touched by dirty ranges of pages to drive, consecutive blocks with one call"""
+        if not self.dirty_ranges:
+            return
+        self._forget_behind_end()
+        clusters = self._file_clusters()
+        blocks_per_clust = self.fs.blocks_per_clust
+
+        run_block_id = None
+        run = []
+        for file_block in self._dirty_blocks():
+            index, block_in_cluster = divmod(file_block, blocks_per_clust)
+            block_id = self.fs.data_cluster_block(clusters[index]) + block_in_cluster
+            if run and run_block_id + len(run) != block_id:
+                self.fs.data_blocks_write(run_block_id, run)
+                run = []
+            if not run:
+                run_block_id = block_id
+            offset = block_in_cluster * BLOCK_SIZE
+            run.append(memoryview(self.pages[index])[offset:offset + BLOCK_SIZE])
+        if run:
+            self.fs.data_blocks_write(run_block_id, run)
+
+        self.dirty_ranges = []
 
     def _extend_clusters(self, current_clusters, new_clusters):
         number_of_clusters_to_add = new_clusters - current_clusters
 
-        last_cluster = self.fs.get_last_cluster(self.fat_dir_entry.fst_cluster_id)
-        empty_clusters = self.fs.get_empty_clusters()
-
-        for idx in range(number_of_clusters_to_add):
-            self.fs.write_next_cluster_to_cluster(last_cluster, empty_clusters[idx])
-            last_cluster = empty_clusters[idx]
+        file_clusters = self._file_clusters()
+        last_cluster = file_clusters[-1]
 
-        self.fs.write_next_cluster_to_cluster(last_cluster, EOC_CLUSTER)
-        self.fat_dir_entry.size = new_clusters
-        self.file_size = new_clusters * self.fs.blocks_per_clust * BLOCK_SIZE
+        with self.fs.transaction():
+            # new clusters continue right after the last one if it is possible
+            new_clusters_ids = self.fs.allocate_clusters(number_of_clusters_to_add, last_cluster + 1)
+            if new_clusters_ids is None:
+                raise ValueError("Not enough empty clusters on drive")
+            self.fs.write_next_cluster_to_cluster(last_cluster, new_clusters_ids[0])
+            self.fat_dir_entry.size = new_clusters
+            FatDirEntry.update_fat_dir_entry(self.fs, self.fat_dir_entry)
+            # chain is shared with other descriptors, it is changed under FAT lock
+            file_clusters.extend(new_clusters_ids)
 
     def _shrink_clusters(self, current_clusters, new_clusters):
         number_of_clusters_to_remove = current_clusters - new_clusters
 
-        file_clusters = self.fs.get_file_clusters(self.fat_dir_entry.fst_cluster_id)
+        file_clusters = self._file_clusters()
         clusters_to_remove = file_clusters[len(file_clusters) - number_of_clusters_to_remove:]
         new_eoc_cluster_id = file_clusters[len(file_clusters) - number_of_clusters_to_remove - 1]
 
-        # empty clusters
-        for index in range(number_of_clusters_to_remove):
-            self.fs.write_value_to_cluster(clusters_to_remove[index], EMPTY_CLUSTER)
-        # set end of chain
-        self.fs.write_value_to_cluster(new_eoc_cluster_id, EOC_CLUSTER)
+        with self.fs.transaction():
+            # empty clusters, they are cleared, so clusters allocated later are zero
+            self.fs.free_clusters(clusters_to_remove)
+            # set end of chain
+            self.fs.write_value_to_cluster(new_eoc_cluster_id, self.fs.eoc_cluster)
+            self.fat_dir_entry.size = new_clusters
+            FatDirEntry.update_fat_dir_entry(self.fs, self.fat_dir_entry)
+            del file_clusters[new_clusters:]
 
-        self.fat_dir_entry.size = new_clusters
-        self.file_size = new_clusters * self.fs.blocks_per_clust * BLOCK_SIZE
+        self._forget_behind_end()
 
+    def _forget_behind_end(self):
+        """Forget pages and dirty ranges behind the end of file, file can be shrunk by other descriptor too"""
+        clusters = self.fat_dir_entry.size
+        for index in [index for index in self.pages if index >= clusters]:
+            del self.pages[index]
+        self.dirty_ranges = [(start, min(end, self.file_size)) for start, end in self.dirty_ranges
+                             if start < self.file_size]
+
+    @timed('fd_truncate')
+    @synchronized
     def truncate(self, size):
-        current_cluster_count = int(self.file_size / (self.fs.blocks_per_clust * BLOCK_SIZE))
-        new_cluster_count = ceil(size / (self.fs.blocks_per_clust * BLOCK_SIZE))
-
-        if current_cluster_count < new_cluster_count:
-            self._extend_clusters(current_cluster_count, new_cluster_count)
-            return self._load_file_to_buffer()
-        elif current_cluster_count > new_cluster_count:
-            self._shrink_clusters(current_cluster_count, new_cluster_count)
-            return self._load_file_to_buffer()
+        # size of file is read under FAT lock, other descriptors of file can not change it meanwhile
+        with self.fs.transaction():
+            current_cluster_count = self.file_size // self.cluster_size
+            # file has always at least one cluster
+            new_cluster_count = max(1, ceil(size / self.cluster_size))
+
+            if current_cluster_count < new_cluster_count:
+                self._extend_clusters(current_cluster_count, new_cluster_count)
+            elif current_cluster_count > new_cluster_count:
+                self._shrink_clusters(current_cluster_count, new_cluster_count)
         return None
 
+    @synchronized
     def seek(self, position):
         if position > self.file_size or position < 0:
             raise IndexError("Position is out of range of file")
         self.file_offset = position
+        self.current_cluster = self.cluster_of_position(position)
 
+    @synchronized
     def stat(self):
         return self.file_size
 
+    @synchronized
     def tell(self):
         return self.file_offset
 
+    @timed('fd_read')
+    @synchronized
     def read(self, size):
         offset = self.file_offset
         if size > self.file_size - offset:
             return ''
         self.file_offset += size
-        return self.buffer[offset: offset + size].decode('utf-8').rstrip('\0')
+        return self._read_bytes(offset, size).decode('utf-8').rstrip('\0')
 
+    @timed('fd_write')
+    @synchronized
     def write(self, data):
         position = self.file_offset
+        byte_array = data.encode('utf-8')
         remaining_file_space = self.file_size - position
-        data_len = len(data)
+        data_len = len(byte_array)
         if remaining_file_space < data_len:
-            data_len - remaining_file_space
             # extend file with data that overflows
             self.truncate(self.file_size + data_len - remaining_file_space)
             self.file_offset = position
 
-        idx = self.file_offset
-        # insert data to do buffer
-        byte_array = bytearray(data, 'utf-8')
-        for byte in byte_array:
-            self.buffer[idx] = byte
-            idx += 1
-        # write data from buffer to virtual drive
-        self._write_buffer_to_drive()
+        # write only changed blocks to virtual drive
+        self._copy_in(position, byte_array)
+
+    @timed('fd_read')
+    @synchronized
+    def readinto(self, buffer):
+        """Read bytes from current position to writable buffer, return number of bytes read (0 at end of file)"""
+        view = memoryview(buffer).cast('B')
+        size = min(len(view), self.file_size - self.file_offset)
+        if size <= 0:
+            return 0
+        self._copy_out(self.file_offset, view[:size])
+        self.file_offset += size
+        return size
+
+    @timed('fd_read')
+    @synchronized
+    def pread(self, position, size):
+        """Return at most size bytes of file from position (empty at end of file), position of descriptor stays"""
+        size = min(size, self.file_size - position)
+        if size <= 0:
+            return b''
+        data = bytearray(size)
+        self._copy_out(position, memoryview(data))
+        return bytes(data)
+
+    def iter_chunks(self, chunk_size=None):
+        """Yield bytes of file from current position to its end in chunks (of size of cluster by default)"""
+        if chunk_size is None:
+            chunk_size = self.cluster_size
+        if chunk_size < 1:
+            raise ValueError("Size of chunk has to be positive")
+        buffer = bytearray(chunk_size)
+        while True:
+            read = self.readinto(buffer)
+            if read == 0:
+                return
+            yield bytes(buffer[:read])
+
+    @timed('fd_write')
+    @synchronized
+    def write_from(self, iterable):
+        """
+        Write binary chunks (bytes-like objects) from current position, file is extended as needed
+        Unlike write, position is moved behind written data, return number of written bytes
+        """
+        total = 0
+        for chunk in iterable:
+            data_len = len(memoryview(chunk).cast('B'))
+            if data_len == 0:
+                continue
+            position = self.file_offset
+            if self.file_size - position < data_len:
+                self.truncate(position + data_len)
+            self._copy_in(position, chunk)
+            self.file_offset = position + data_len
+            total += data_len
+        return total
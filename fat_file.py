@@ -1,3 +1,5 @@
+import io
+
 from fat_dir_entry import FatDirEntry
 from fat_fd import FatFd
 
@@ -13,13 +15,16 @@ class FatFile:
     def is_open(self):
         return isinstance(self.fat_fd, FatFd)
 
-    def open(self):
-        """Find/Create FatDirEntry in FAT table and return instance of FatFd to work with file"""
+    def open(self, page_window=None):
+        """
+        Find/Create FatDirEntry in FAT table and return instance of FatFd to work with file
+        page_window - maximal number of clusters of file held in memory by FatFd
+        """
         if self.is_open():
             return
 
         self.fat_dir_entry = FatDirEntry.open(self.fs, self.file_name)
-        self.fat_fd = FatFd(self.fs, self.fat_dir_entry)
+        self.fat_fd = FatFd(self.fs, self.fat_dir_entry, page_window)
 
         return self.fat_fd
 
@@ -27,11 +32,61 @@ class FatFile:
         self.fat_fd = None
         self.fat_dir_entry = None
 
-    def delete(self):
-        FatDirEntry.file_delete(self.fs, self.file_name)
+    def raw(self, page_window=None):
+        """Return binary stream (io.RawIOBase) over opened file, file is opened if it is needed"""
+        if not self.is_open():
+            self.open(page_window)
+        return FatFileIO(self.fat_fd)
+
+    def delete(self, wipe=False):
+        """Delete file, data are discarded on drive or overwritten by zeros with wipe"""
+        FatDirEntry.file_delete(self.fs, self.file_name, wipe)
+        if self.is_open():
+            self.fat_fd.invalidate_clusters()
         self.close()
 
 
+class FatFileIO(io.RawIOBase):
+    """
+    Binary stream over FatFd, it can be wrapped to io.BufferedReader/BufferedWriter or used by shutil.copyfileobj
+    File has size in whole clusters, so data read at the end of file are padded by zeros
+    """
+    def __init__(self, fat_fd):
+        super().__init__()
+        self.fat_fd = fat_fd
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.fat_fd.readinto(buffer)
+
+    def write(self, data):
+        return self.fat_fd.write_from([data])
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.fat_fd.tell()
+        elif whence == io.SEEK_END:
+            offset += self.fat_fd.stat()
+        elif whence != io.SEEK_SET:
+            raise ValueError("Not valid whence")
+        self.fat_fd.seek(offset)
+        return offset
 
+    def tell(self):
+        return self.fat_fd.tell()
 
+    def truncate(self, size=None):
+        self.fat_fd.truncate(self.fat_fd.tell() if size is None else size)
+        return self.fat_fd.stat()
 
+    def flush(self):
+        super().flush()
+        self.fat_fd.flush()
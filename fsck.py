@@ -0,0 +1,321 @@
+import argparse
+import sys
+from time import perf_counter
+
+from cache import Cache
+from fat_dir_entry import FatDirEntry
+from root_dir_index import RootDirIndex
+from virtual_drive import VirtualDrive
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# end of chain of cluster in result of analysis, cycle is marked by CYCLE
+END_EOC = 0
+END_BROKEN = 1
+CYCLE = 2
+
+
+class FsckReport:
+    """
+    Problems found in file system
+    invalid_clusters - clusters whose FAT entry is neither cluster id, EOC nor empty
+    cross_linked - clusters which are in more chains (or first cluster of file which is in other chain)
+    orphans - used clusters which are not in chain of any file
+    cycles, broken - files whose chain loops or ends in empty or invalid cluster instead of EOC
+    size_mismatch - (file name, size in root directory, number of clusters of chain)
+    bad_entries - files whose first cluster is not valid used cluster
+    duplicates - names which are in root directory more than once
+    """
+    def __init__(self, backend):
+        self.backend = backend      # 'numpy' or 'python'
+        self.invalid_clusters = []
+        self.cross_linked = []
+        self.orphans = []
+        self.cycles = []
+        self.broken = []
+        self.size_mismatch = []
+        self.bad_entries = []
+        self.duplicates = []
+        self.repaired = False
+        self.seconds = None
+
+    def __repr__(self):
+        return (f"FsckReport(ok: {self.ok}, invalid: {len(self.invalid_clusters)}, "
+                f"cross_linked: {len(self.cross_linked)}, orphans: {len(self.orphans)}, cycles: {len(self.cycles)}, "
+                f"broken: {len(self.broken)}, size_mismatch: {len(self.size_mismatch)}, "
+                f"bad_entries: {len(self.bad_entries)}, duplicates: {len(self.duplicates)}, "
+                f"repaired: {self.repaired})")
+
+    def __str__(self):
+        return self.__repr__()
+
+    @property
+    def ok(self):
+        return not (self.invalid_clusters or self.cross_linked or self.orphans or self.cycles or self.broken or
+                    self.size_mismatch or self.bad_entries or self.duplicates)
+
+    def problems(self):
+        """Return list of found problems as text"""
+        lines = [f"cluster {cluster_id} has invalid FAT entry" for cluster_id in self.invalid_clusters]
+        lines += [f"cluster {cluster_id} is cross-linked" for cluster_id in self.cross_linked]
+        if self.orphans:
+            lines.append(f"{len(self.orphans)} orphaned clusters, the first one is {self.orphans[0]}")
+        lines += [f"chain of file {name} has cycle" for name in self.cycles]
+        lines += [f"chain of file {name} does not end with EOC" for name in self.broken]
+        lines += [f"file {name} has size {size} clusters, its chain has {length}"
+                  for name, size, length in self.size_mismatch]
+        lines += [f"file {name} has not valid first cluster" for name in self.bad_entries]
+        lines += [f"file {name} is in root directory more than once" for name in self.duplicates]
+        return lines
+
+    def to_dict(self):
+        return {'ok': self.ok, 'backend': self.backend, 'seconds': self.seconds, 'repaired': self.repaired,
+                'invalid_clusters': self.invalid_clusters, 'cross_linked': self.cross_linked,
+                'orphans': len(self.orphans), 'cycles': self.cycles, 'broken': self.broken,
+                'size_mismatch': self.size_mismatch, 'bad_entries': self.bad_entries, 'duplicates': self.duplicates}
+
+
+def _analyze_numpy(fs, heads):
+    """
+    Follow all chains at once with pointer doubling, every round doubles length of followed part of chains
+    Return (invalid clusters, cross-linked clusters, orphans, end of chain of every head, length of every head)
+    """
+    count = fs.cluster_count
+    fat = numpy.frombuffer(fs.fat, dtype=fs.layout.fat_typecode).astype(numpy.int64)
+    eoc, broken = count, count + 1      # sentinels which end chains
+
+    used = fat != fs.empty_cluster
+    valid = fat < count
+    target = numpy.where(valid, fat, 0)
+    # chain ends with EOC, pointer to empty or invalid cluster ends it as broken
+    successor = numpy.where(valid & used[target], fat, numpy.where(fat == fs.eoc_cluster, eoc, broken))
+    successor[~used] = broken
+    invalid = numpy.flatnonzero(used & ~valid & (fat != fs.eoc_cluster))
+
+    heads = numpy.asarray(heads, dtype=numpy.int64)
+    references = numpy.bincount(successor[used], minlength=count + 2)[:count]
+    references += numpy.bincount(heads, minlength=count)
+    cross_linked = numpy.flatnonzero(references > 1)
+
+    jump = numpy.concatenate([successor, [eoc, broken]])
+    steps = (jump < count).astype(numpy.int64)
+    reached = numpy.zeros(count + 2, dtype=bool)
+    reached[heads] = True
+    for _ in range((count + 2).bit_length()):
+        # clusters up to twice farther from heads are reached
+        reached[jump[reached]] = True
+        steps += steps[jump]
+        following = jump[jump]
+        # all chains reached their ends, rounds are not given by the longest possible chain
+        if numpy.array_equal(following, jump):
+            break
+        jump = following
+    orphans = numpy.flatnonzero(used & ~reached[:count])
+
+    ends = numpy.where(jump[heads] == eoc, END_EOC, numpy.where(jump[heads] == broken, END_BROKEN, CYCLE))
+    return invalid.tolist(), cross_linked.tolist(), orphans.tolist(), ends.tolist(), (steps[heads] + 1).tolist()
+
+
+def _analyze_python(fs, heads):
+    """Follow chains one by one, every cluster is walked once, result is the same as of _analyze_numpy"""
+    count = fs.cluster_count
+    fat = fs.fat
+    empty, eoc = fs.empty_cluster, fs.eoc_cluster
+
+    invalid = []
+    references = [0] * count
+    for cluster_id in heads:
+        references[cluster_id] += 1
+    for cluster_id, value in enumerate(fat):
+        if value < count and fat[value] != empty:
+            references[value] += 1
+        elif value != empty and value != eoc and value >= count:
+            invalid.append(cluster_id)
+    cross_linked = [cluster_id for cluster_id, value in enumerate(references) if value > 1]
+
+    end = [None] * count            # end of chain from cluster, None if it was not walked yet
+    length = [0] * count            # number of clusters from cluster to end of its chain
+    reached = bytearray(count)
+    for head in heads:
+        path = []
+        on_path = set()
+        cluster_id = head
+        while True:
+            if end[cluster_id] is not None:
+                # rest of chain was already walked from other head
+                chain_end, chain_length = end[cluster_id], length[cluster_id]
+                break
+            if cluster_id in on_path:
+                chain_end, chain_length = CYCLE, 0
+                break
+            path.append(cluster_id)
+            on_path.add(cluster_id)
+            value = fat[cluster_id]
+            if value == eoc:
+                chain_end, chain_length = END_EOC, 0
+                break
+            if value >= count or fat[value] == empty:
+                chain_end, chain_length = END_BROKEN, 0
+                break
+            cluster_id = value
+
+        for cluster_id in reversed(path):
+            chain_length += 1
+            end[cluster_id] = chain_end
+            length[cluster_id] = chain_length
+            reached[cluster_id] = 1
+
+    orphans = [cluster_id for cluster_id, value in enumerate(fat) if value != empty and not reached[cluster_id]]
+    return invalid, cross_linked, orphans, [end[head] for head in heads], [length[head] for head in heads]
+
+
+def _write_entry(fs, slot, data):
+    """Write binary entry to slot of root directory"""
+    block_id, index_in_block = fs.root_dir.slot_location(slot)
+    root_block = bytearray(fs.read_metadata_block(block_id))
+    root_block[index_in_block:index_in_block + len(data)] = data
+    fs.write_metadata_blocks(block_id, [root_block])
+
+
+def _unique_name(file_name, names, max_size):
+    """Return name with suffix ~number which is not in names"""
+    number = 1
+    while True:
+        suffix = f'~{number}'
+        candidate = file_name[:max_size - len(suffix)] + suffix
+        if candidate not in names:
+            return candidate
+        number += 1
+
+
+def _repair(fs):
+    """
+    Make file system consistent, files are processed in order of root directory
+    Entries with invalid first cluster or with first cluster of other file are removed, duplicate names are renamed,
+    chains are cut by EOC before invalid, empty or already used cluster, sizes are set by chains
+    and orphaned clusters are freed
+    """
+    count = fs.cluster_count
+    fat = fs.fat
+    root_dir = fs.root_dir
+    empty_entry = bytes(fs.layout.dir_entry_size)
+    names = set(root_dir.slots)
+    owned = bytearray(count)
+
+    with fs.transaction(), fs.dir_lock:
+        for slot in root_dir.occupied_slots():
+            file_name = root_dir.names[slot]
+            cluster_id = root_dir.clusters[slot]
+            if cluster_id >= count or fat[cluster_id] == fs.empty_cluster or owned[cluster_id]:
+                _write_entry(fs, slot, empty_entry)
+                continue
+
+            length = 1
+            owned[cluster_id] = 1
+            while fat[cluster_id] != fs.eoc_cluster:
+                value = fat[cluster_id]
+                if value >= count or fat[value] == fs.empty_cluster or owned[value]:
+                    fs.write_value_to_cluster(cluster_id, fs.eoc_cluster)
+                    break
+                cluster_id = value
+                owned[cluster_id] = 1
+                length += 1
+
+            if root_dir.slots.get(file_name) != slot:
+                file_name = _unique_name(file_name, names, fs.layout.file_name_max_size)
+                names.add(file_name)
+            if file_name != root_dir.names[slot] or length != root_dir.sizes[slot]:
+                fde = FatDirEntry(file_name, root_dir.clusters[slot], length, fs.layout)
+                _write_entry(fs, slot, fde.to_binary())
+
+        for cluster_id in range(count):
+            if fat[cluster_id] != fs.empty_cluster and not owned[cluster_id]:
+                fs.write_value_to_cluster(cluster_id, fs.empty_cluster)
+
+    # changes are committed before root directory is read again
+    fs.flush()
+    with fs.dir_lock:
+        fs.root_dir = RootDirIndex.build(fs)
+    fs.forget_chains()
+
+
+def fsck(fs, repair=False, use_numpy=True):
+    """
+    Check consistency of FAT and root directory of opened file system and return FsckReport
+    All chains are followed at once with NumPy if it is installed (and use_numpy), pure Python is used otherwise
+    repair - fix found problems (see _repair), report describes state before repair
+    """
+    began = perf_counter()
+    use_numpy = use_numpy and numpy is not None
+    report = FsckReport('numpy' if use_numpy else 'python')
+
+    with fs.fat_lock, fs.dir_lock:
+        root_dir = fs.root_dir
+        slots = []
+        seen = set()
+        for slot in root_dir.occupied_slots():
+            file_name = root_dir.names[slot]
+            if file_name in seen and file_name not in report.duplicates:
+                report.duplicates.append(file_name)
+            seen.add(file_name)
+            cluster_id = root_dir.clusters[slot]
+            if cluster_id >= fs.cluster_count or fs.fat[cluster_id] == fs.empty_cluster:
+                report.bad_entries.append(file_name)
+            else:
+                slots.append(slot)
+
+        heads = [root_dir.clusters[slot] for slot in slots]
+        analyze = _analyze_numpy if use_numpy else _analyze_python
+        report.invalid_clusters, report.cross_linked, report.orphans, ends, lengths = analyze(fs, heads)
+
+        for slot, chain_end, length in zip(slots, ends, lengths):
+            file_name = root_dir.names[slot]
+            if chain_end == CYCLE:
+                report.cycles.append(file_name)
+                continue
+            if chain_end == END_BROKEN:
+                report.broken.append(file_name)
+            if length != root_dir.sizes[slot]:
+                report.size_mismatch.append((file_name, root_dir.sizes[slot], length))
+
+        if repair and not report.ok:
+            _repair(fs)
+            report.repaired = True
+
+    report.seconds = perf_counter() - began
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check consistency of FAT and root directory of Fat8 image")
+    parser.add_argument('image', help="file of virtual drive")
+    parser.add_argument('--repair', action='store_true', help="fix found problems")
+    parser.add_argument('--no-numpy', action='store_true', help="use pure Python even if NumPy is installed")
+    parser.add_argument('--cache-blocks', type=int, default=64, help="capacity of cache in blocks")
+    args = parser.parse_args(argv)
+
+    # fat8 imports this module for check on open
+    from fat8 import Fat8
+    drive = VirtualDrive.open(args.image)
+    fs = Fat8()
+    try:
+        fs.open(Cache(drive, args.cache_blocks))
+        report = fsck(fs, args.repair, not args.no_numpy)
+        fs.close()
+    finally:
+        drive.close()
+
+    for line in report.problems():
+        print(line)
+    print(report)
+    # exit status: 0 - consistent, 1 - problems were repaired, 4 - problems are left
+    if report.ok:
+        return 0
+    return 1 if report.repaired else 4
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,153 @@
+import struct
+import zlib
+from math import ceil
+
+from constants import *
+
+JOURNAL_MAGIC = b'FAT8jrnl'
+# magic, sequence number of record, number of blocks in record, checksum of block ids and data of blocks
+JOURNAL_HEADER_STRUCT = struct.Struct('<8sQII')
+# number of transactions which are committed to journal together
+GROUP_COMMIT = 16
+
+
+def _header_blocks(count):
+    """Return number of blocks of header of record with count blocks (header is followed by ids of blocks)"""
+    return ceil((JOURNAL_HEADER_STRUCT.size + 4 * count) / BLOCK_SIZE)
+
+
+def record_blocks(count):
+    """Return number of journal blocks which are needed for record with count blocks"""
+    return _header_blocks(count) + count
+
+
+class Journal:
+    """
+    Write ahead journal of metadata blocks (FAT and root directory) in journal region of drive
+    Blocks changed by a transaction are kept in memory, finished transactions are collected to a group
+    which is committed at once - new content of its blocks is written to journal with one call and made
+    durable, then blocks are written to their places (checkpoint)
+    Journal holds only the last record and it is replayed on open, so metadata on drive are as before
+    or as after the whole group. Group is committed before it would not fit to one record and journal
+    has to be large enough for every transaction (layout makes it to hold all metadata blocks)
+    Actions which must not happen before changes are durable (e.g. reuse of freed clusters) are deferred
+    until the group is checkpointed
+    """
+    def __init__(self, cache, first_block, blocks, group_commit=GROUP_COMMIT):
+        if blocks < 2:
+            raise ValueError("Journal has to have at least two blocks")
+        self.cache = cache
+        self.first_block = first_block
+        self.blocks = blocks
+        self.group_commit = group_commit    # number of transactions in group
+        self.sequence = 0                   # sequence number of the next record
+        self.running = {}                   # block id -> data changed by transaction in progress
+        self.pending = {}                   # block id -> data changed by finished transactions of group
+        self.transactions = 0               # number of finished transactions in group
+        self.running_deferred = []          # (function, arguments) called after transaction in progress is committed
+        self.pending_deferred = []          # (function, arguments) called after group is committed
+
+        # the most blocks which fit to one record
+        self.capacity = blocks - 1
+        while record_blocks(self.capacity) > blocks:
+            self.capacity -= 1
+
+    def __repr__(self):
+        return (f"Journal(blocks: {self.blocks}, sequence: {self.sequence}, transactions: {self.transactions}, "
+                f"pending: {len(self.pending)})")
+
+    def _count(self, name, value=1):
+        if self.cache.stats is not None:
+            self.cache.stats.inc(name, value=value)
+
+    def block(self, block_id):
+        """Return data of block changed in journal which are not checkpointed yet or None"""
+        data = self.running.get(block_id)
+        if data is None:
+            data = self.pending.get(block_id)
+        return data
+
+    def stage(self, block_id, data):
+        """Put new data of block to transaction in progress"""
+        self.running[block_id] = bytes(data)
+
+    def defer(self, function, *args):
+        """Call function with args after transaction in progress is committed"""
+        self.running_deferred.append((function, args))
+
+    def end_transaction(self):
+        """Add finished transaction to group, group is committed when it has group_commit transactions"""
+        if not self.running and not self.running_deferred:
+            return
+        if len(self.running) > self.capacity:
+            # split record would not be atomic
+            raise ValueError(f"Transaction changes {len(self.running)} blocks, journal holds only {self.capacity}")
+        if len(self.pending.keys() | self.running.keys()) > self.capacity:
+            # group would not fit to one record
+            self.commit()
+        self.pending.update(self.running)
+        self.pending_deferred += self.running_deferred
+        self.running = {}
+        self.running_deferred = []
+        self.transactions += 1
+        if self.transactions >= self.group_commit:
+            self.commit()
+
+    def commit(self):
+        """Write group to journal as one record, make it durable and checkpoint it"""
+        if not self.pending and not self.pending_deferred:
+            return
+        if self.pending:
+            self._write_record(sorted(self.pending))
+        self._count('journal_commits')
+        self._count('journal_transactions', self.transactions)
+        deferred = self.pending_deferred
+        self.pending = {}
+        self.pending_deferred = []
+        self.transactions = 0
+        for function, args in deferred:
+            function(*args)
+
+    def _write_record(self, block_ids):
+        """Write one record with blocks to journal and then the blocks to their places"""
+        buffers = [self.pending[block_id] for block_id in block_ids]
+        ids = struct.pack(f'<{len(block_ids)}I', *block_ids)
+        checksum = zlib.crc32(b''.join(buffers), zlib.crc32(ids))
+        header = JOURNAL_HEADER_STRUCT.pack(JOURNAL_MAGIC, self.sequence, len(block_ids), checksum) + ids
+        header = header.ljust(_header_blocks(len(block_ids)) * BLOCK_SIZE, b'\0')
+        self.cache.write_around(self.first_block, [header[idx:idx + BLOCK_SIZE]
+                                                   for idx in range(0, len(header), BLOCK_SIZE)] + buffers)
+        self.sequence += 1
+        self._count('journal_blocks', len(block_ids))
+        self._checkpoint(block_ids, buffers)
+
+    def _checkpoint(self, block_ids, buffers):
+        """Write blocks to their places, consecutive blocks with one call, and make them durable"""
+        start = 0
+        for idx in range(1, len(block_ids) + 1):
+            if idx == len(block_ids) or block_ids[idx] != block_ids[idx - 1] + 1:
+                self.cache.write_blocks(block_ids[start], buffers[start:idx])
+                start = idx
+        self.cache.sync_blocks(block_ids)
+
+    def replay(self):
+        """Checkpoint the last record of journal again if it is complete, return number of its blocks"""
+        drive = self.cache.drive
+        header = drive.read_blocks(self.first_block, 1)
+        magic, sequence, count, checksum = JOURNAL_HEADER_STRUCT.unpack_from(header)
+        if magic != JOURNAL_MAGIC or not 0 < count <= self.capacity:
+            return 0
+
+        header_blocks = _header_blocks(count)
+        record = drive.read_blocks(self.first_block, header_blocks + count)
+        ids = record[JOURNAL_HEADER_STRUCT.size:JOURNAL_HEADER_STRUCT.size + 4 * count]
+        data = memoryview(record)[header_blocks * BLOCK_SIZE:]
+        # record which was not written whole is ignored, its checkpoint did not start
+        if zlib.crc32(data, zlib.crc32(ids)) != checksum:
+            return 0
+
+        block_ids = list(struct.unpack(f'<{count}I', ids))
+        self._checkpoint(block_ids, [bytes(data[idx * BLOCK_SIZE:(idx + 1) * BLOCK_SIZE]) for idx in range(count)])
+        self.sequence = sequence + 1
+        self._count('journal_replayed_blocks', count)
+        return count
@@ -0,0 +1,225 @@
+import struct
+import sys
+from array import array
+from math import ceil, floor
+
+from constants import *
+from journal import record_blocks
+
+# boot block of version 2 has magic behind header of version 1
+V2_MAGIC = b'FAT8v2\0\0'
+V2_MAGIC_OFFSET = STRUCT_BUFFER
+# magic, version, block size, blocks per cluster, number of clusters, FAT blocks, root directory blocks,
+# size of file system in bytes, size of FAT entry in bytes, journal blocks (0 in images without journal)
+V2_BOOT_STRUCT = struct.Struct('<8sHIIIIIQBI')
+
+V2_DIR_ENTRY_SIZE = 32
+V2_FILE_NAME_MAX_SIZE = V2_DIR_ENTRY_SIZE - 8   # file name + id of first cluster (4B) + size of file (4B)
+V2_ROOT_ENTRIES = 512
+V2_BLOCKS_PER_CLUSTER = 4
+V2_JOURNAL_BLOCKS = 64
+
+# typecode of array for FAT entry of given size
+FAT_TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+
+
+class Layout:
+    """
+    Geometry of file system on drive
+    Version 1 is the original FAT8 - one FAT block with 8-bit entries for 254 clusters and 16 byte directory entries,
+    cluster size is given by size of drive
+    Version 2 has FAT with 16/32-bit entries in more blocks, chosen cluster size, number of clusters given
+    by size of drive and 32 byte directory entries, it is recorded by magic in boot block
+    Version 2 can have journal of metadata between root directory and data blocks
+    """
+    def __init__(self, version, blocks_per_clust, cluster_count, root_directory_blocks, fat_entry_size=1,
+                 fat_blocks=FAT_BLOCK_SIZE, journal_blocks=0):
+        if fat_entry_size not in FAT_TYPECODES:
+            raise ValueError("Not valid size of FAT entry")
+        self.version = version
+        self.block_size = BLOCK_SIZE
+        self.blocks_per_clust = blocks_per_clust
+        self.cluster_count = cluster_count
+        self.root_directory_blocks = root_directory_blocks
+        self.fat_entry_size = fat_entry_size
+        self.fat_blocks = fat_blocks
+        self.journal_blocks = journal_blocks
+        self.fat_typecode = FAT_TYPECODES[fat_entry_size]
+
+        # the highest values of FAT entry mark empty cluster and end of chain
+        self.empty_cluster = (1 << (8 * fat_entry_size)) - 1
+        self.eoc_cluster = self.empty_cluster - 1
+        if cluster_count > self.eoc_cluster:
+            raise ValueError("Too many clusters for size of FAT entry")
+
+        if version == 1:
+            self.dir_entry_size = DIR_ENTRY_SIZE
+            self.file_name_max_size = FILE_NAME_MAX_SIZE
+            self.entry_struct = struct.Struct(f'{FILE_NAME_MAX_SIZE}sBI')
+        else:
+            self.dir_entry_size = V2_DIR_ENTRY_SIZE
+            self.file_name_max_size = V2_FILE_NAME_MAX_SIZE
+            self.entry_struct = struct.Struct(f'<{V2_FILE_NAME_MAX_SIZE}sII')
+        self.entries_per_block = BLOCK_SIZE // self.dir_entry_size
+        self.data_blocks = blocks_per_clust * cluster_count
+
+    def __repr__(self):
+        return (f"Layout(version: {self.version}, blocks_per_clust: {self.blocks_per_clust}, "
+                f"clusters: {self.cluster_count}, fat_entry_size: {self.fat_entry_size}, fat_blocks: {self.fat_blocks}, "
+                f"journal_blocks: {self.journal_blocks})")
+
+    @classmethod
+    def v1(cls, drive_blocks):
+        """
+        Return layout of version 1, cluster size is given by size of drive
+        Data start behind boot block, FAT and root directory counted in clusters, so they take a cluster per block
+        """
+        root_directory_blocks = ceil(DIR_ENTRY_SIZE * FAT_MAX_CLUSTERS / BLOCK_SIZE)
+        clusters = BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE + root_directory_blocks + FAT_MAX_CLUSTERS
+        if drive_blocks < clusters:
+            raise ValueError("Drive is too small for file system")
+        return cls(1, floor(drive_blocks / clusters), FAT_MAX_CLUSTERS, root_directory_blocks)
+
+    @classmethod
+    def v2(cls, drive_blocks, blocks_per_clust=None, fat_entry_size=None, root_entries=None, journal_blocks=None):
+        """
+        Return layout of version 2 with as many clusters as fit to drive
+        fat_entry_size - 2 or 4 bytes, the smaller one which can address all clusters is chosen by default
+        journal_blocks - size of journal, 0 is file system without journal, it has to hold record with all FAT
+        and root directory blocks, by default it is V2_JOURNAL_BLOCKS or larger if they do not fit
+        """
+        if blocks_per_clust is None:
+            blocks_per_clust = V2_BLOCKS_PER_CLUSTER
+        if root_entries is None:
+            root_entries = V2_ROOT_ENTRIES
+        default_journal = journal_blocks is None
+        if default_journal:
+            journal_blocks = V2_JOURNAL_BLOCKS
+        if blocks_per_clust < 1:
+            raise ValueError("Cluster has to have at least one block")
+        if root_entries < 1:
+            raise ValueError("Root directory has to have at least one entry")
+        if journal_blocks == 1 or journal_blocks < 0:
+            raise ValueError("Journal has to have at least two blocks")
+        root_directory_blocks = ceil(root_entries * V2_DIR_ENTRY_SIZE / BLOCK_SIZE)
+
+        while True:
+            entry_size, cluster_count = cls._v2_clusters(
+                drive_blocks - BOOT_BLOCK_SIZE - root_directory_blocks - journal_blocks, blocks_per_clust, fat_entry_size)
+            if cluster_count < 1:
+                raise ValueError("Drive is too small for file system")
+            fat_blocks = ceil(cluster_count * entry_size / BLOCK_SIZE)
+            # one transaction can change all FAT and root directory blocks, its record has to fit to journal
+            needed = record_blocks(fat_blocks + root_directory_blocks)
+            if journal_blocks == 0 or needed <= journal_blocks:
+                break
+            if not default_journal:
+                raise ValueError(f"Journal has to have at least {needed} blocks for all FAT and root directory blocks")
+            # larger journal leaves less clusters, so their FAT fits to it in the next round
+            journal_blocks = needed
+        return cls(2, blocks_per_clust, cluster_count, root_directory_blocks, entry_size, fat_blocks, journal_blocks)
+
+    @staticmethod
+    def _v2_clusters(available, blocks_per_clust, fat_entry_size):
+        """
+        Return (size of FAT entry, number of clusters) which fit to available blocks with their FAT
+        fat_entry_size - 2 or 4 bytes, the smaller one which can address all clusters is chosen if it is None
+        """
+        for entry_size in ((fat_entry_size,) if fat_entry_size is not None else (2, 4)):
+            if entry_size not in (2, 4):
+                raise ValueError("Size of FAT entry of version 2 has to be 2 or 4 bytes")
+            max_clusters = (1 << (8 * entry_size)) - 2
+            # every cluster takes its blocks and its entry in FAT
+            cluster_count = min(max_clusters, floor(available * BLOCK_SIZE / (blocks_per_clust * BLOCK_SIZE + entry_size)))
+            while cluster_count > 0 and \
+                    ceil(cluster_count * entry_size / BLOCK_SIZE) + cluster_count * blocks_per_clust > available:
+                cluster_count -= 1
+            if cluster_count < max_clusters or fat_entry_size is not None or entry_size == 4:
+                break
+        return entry_size, cluster_count
+
+    @classmethod
+    def from_boot_block(cls, data):
+        """Return layout recorded in boot block"""
+        data = bytes(data)
+        if data[V2_MAGIC_OFFSET:V2_MAGIC_OFFSET + len(V2_MAGIC)] != V2_MAGIC:
+            blocks_per_clust, _, root_directory_blocks, _ = struct.unpack('BIII', data[:STRUCT_BUFFER])
+            return cls(1, blocks_per_clust, FAT_MAX_CLUSTERS, root_directory_blocks)
+
+        (_, version, block_size, blocks_per_clust, cluster_count, fat_blocks, root_directory_blocks, _,
+         fat_entry_size, journal_blocks) = V2_BOOT_STRUCT.unpack_from(data, V2_MAGIC_OFFSET)
+        if version != 2:
+            raise ValueError(f"Not supported version {version} of file system")
+        if block_size != BLOCK_SIZE:
+            raise ValueError(f"File system has blocks of {block_size} bytes, drive has {BLOCK_SIZE} bytes")
+        return cls(2, blocks_per_clust, cluster_count, root_directory_blocks, fat_entry_size, fat_blocks,
+                   journal_blocks)
+
+    def first_root_directory_block(self):
+        return BOOT_BLOCK_SIZE + self.fat_blocks
+
+    def first_journal_block(self):
+        return BOOT_BLOCK_SIZE + self.fat_blocks + self.root_directory_blocks
+
+    def first_data_block(self):
+        if self.version == 1:
+            # version 1 starts data behind root directory multiplied by size of cluster
+            return (BOOT_BLOCK_SIZE + FAT_BLOCK_SIZE + self.root_directory_blocks) * self.blocks_per_clust
+        return self.first_journal_block() + self.journal_blocks
+
+    def fs_size_blocks(self):
+        return BOOT_BLOCK_SIZE + self.fat_blocks + self.root_directory_blocks + self.journal_blocks + self.data_blocks
+
+    def boot_block(self):
+        """
+        Return boot block in binary
+        1 byte - blocks per cluter, 4 byty - size of file system
+        4 byty - size of root directory, 4 byty - size of data blocks
+        Version 2 has 0 blocks per cluster in this header and its geometry follows magic
+        Block is padded by zeros, so magic of previous file system on drive does not stay behind header
+        """
+        size = self.fs_size_blocks() * BLOCK_SIZE
+        if self.version == 1:
+            header = struct.pack('BIII', self.blocks_per_clust, size, self.root_directory_blocks, self.data_blocks)
+            return header.ljust(BLOCK_SIZE, b'\0')
+
+        header = struct.pack('BIII', 0, min(size, 0xffffffff), self.root_directory_blocks,
+                             min(self.data_blocks, 0xffffffff))
+        header += V2_BOOT_STRUCT.pack(V2_MAGIC, self.version, BLOCK_SIZE, self.blocks_per_clust, self.cluster_count,
+                                      self.fat_blocks, self.root_directory_blocks, size, self.fat_entry_size,
+                                      self.journal_blocks)
+        return header.ljust(BLOCK_SIZE, b'\0')
+
+    def empty_fat(self):
+        """Return FAT in memory with all clusters empty"""
+        if self.fat_entry_size == 1:
+            return bytearray([self.empty_cluster] * self.cluster_count)
+        return array(self.fat_typecode, [self.empty_cluster]) * self.cluster_count
+
+    def fat_from_bytes(self, data):
+        """Return FAT in memory from data of FAT blocks (entries are little endian)"""
+        data = data[:self.cluster_count * self.fat_entry_size]
+        if self.fat_entry_size == 1:
+            return bytearray(data)
+        fat = array(self.fat_typecode)
+        fat.frombytes(data)
+        if sys.byteorder == 'big':
+            fat.byteswap()
+        return fat
+
+    def fat_to_bytes(self, fat, first_block, count):
+        """Return count blocks of FAT from first_block (index in FAT) in binary, the last block is padded by zeros"""
+        start = first_block * BLOCK_SIZE // self.fat_entry_size
+        end = (first_block + count) * BLOCK_SIZE // self.fat_entry_size
+        entries = fat[start:end]
+        if self.fat_entry_size != 1 and sys.byteorder == 'big':
+            entries.byteswap()
+        return bytes(entries).ljust(count * BLOCK_SIZE, b'\0')
+
+    def fat_block_of_cluster(self, cluster_id):
+        """Return index of FAT block with entry of cluster"""
+        return cluster_id * self.fat_entry_size // BLOCK_SIZE
+
+
+# layout of version 1 with one block per cluster, used by FatDirEntry which does not know its file system
+V1_LAYOUT = Layout(1, 1, FAT_MAX_CLUSTERS, ceil(DIR_ENTRY_SIZE * FAT_MAX_CLUSTERS / BLOCK_SIZE))
@@ -129,3 +129,7 @@ if __name__ == '__main__':
     print("All files after creating/opening file4")
     print(FatDirEntry.read_dir(fat))
     print("")
+
+    # flush file system and close virtual drive
+    fat.close()
+    virtual_drive.close()
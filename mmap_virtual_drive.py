@@ -0,0 +1,79 @@
+import mmap
+import os
+from constants import BLOCK_SIZE
+from virtual_drive import VirtualDrive
+
+
+class MmapVirtualDrive(VirtualDrive):
+    """
+    Virtual drive with backing file mapped to memory
+    read returns memoryview of the mapping instead of copy of data, write goes directly to mapped region
+    All views have to be released (e.g. cache cleared) before the drive is closed
+    """
+    def __init__(self, file_name, size, sync=False):
+        super().__init__(file_name, size, sync)
+        if os.fstat(self.fd).st_size < self.size:
+            os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+        self.view = memoryview(self.map)
+
+    @classmethod
+    def open(cls, file_name, sync=False):
+        """Open virtual drive and return instance of MmapVirtualDrive class"""
+        file_stats = os.stat(file_name)
+        return cls(file_name, file_stats.st_size // BLOCK_SIZE, sync)
+
+    def read(self, block_id):
+        """Return view of one block in mapped virtual drive"""
+        self._check_block_id(block_id)
+        position = block_id * BLOCK_SIZE
+        return self.view[position:position + BLOCK_SIZE]
+
+    def write(self, block):
+        """Copy block to mapped virtual drive"""
+        self._check_block_id(block.block_id)
+        position = block.block_id * BLOCK_SIZE
+        self.view[position:position + len(block.data)] = block.data
+
+        if self.sync_writes:
+            # flush has to start on page boundary
+            page_start = position - position % mmap.PAGESIZE
+            self.map.flush(page_start, position + len(block.data) - page_start)
+
+    def read_blocks(self, start, count):
+        """Return view of count consecutive blocks in mapped virtual drive"""
+        self._check_block_id(start)
+        self._check_block_id(start + count - 1)
+        position = start * BLOCK_SIZE
+        return self.view[position:position + count * BLOCK_SIZE]
+
+    def write_blocks(self, start, buffers):
+        """Copy consecutive blocks to mapped virtual drive"""
+        if len(buffers) == 0:
+            return
+        self._check_block_id(start)
+        self._check_block_id(start + len(buffers) - 1)
+        position = start * BLOCK_SIZE
+        for idx, data in enumerate(buffers):
+            block_position = position + idx * BLOCK_SIZE
+            self.view[block_position:block_position + len(data)] = data
+
+        if self.sync_writes:
+            page_start = position - position % mmap.PAGESIZE
+            self.map.flush(page_start, position + len(buffers) * BLOCK_SIZE - page_start)
+
+    def sync(self):
+        """Make all written blocks durable on backing file"""
+        self.map.flush()
+
+    def close(self):
+        """Unmap and close backing file of virtual drive"""
+        if self.fd is None:
+            return
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            self.view = memoryview(self.map)
+            raise BufferError("Blocks of virtual drive are still in use, clear cache before closing drive")
+        super().close()
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+
+class ReadAhead:
+    """
+    Detection of sequential reads and size of read ahead window for Cache
+    Stream is identified by block where its next read is expected, window of prefetched blocks grows by one
+    with every prefetched block which is used and it is halved when prefetched block is evicted unused
+    """
+    def __init__(self, min_window=2, max_window=64, max_streams=16):
+        if not 1 <= min_window <= max_window:
+            raise ValueError("Not valid size of read ahead window")
+        if max_streams < 1:
+            raise ValueError("Not enough streams")
+        self.min_window = min_window
+        self.max_window = max_window
+        self.max_streams = max_streams
+        self.window = min_window        # number of blocks prefetched for sequential stream
+        self.streams = OrderedDict()    # block where next read of stream is expected -> blocks prefetched from it
+        self.hits = 0                   # prefetched blocks which were used
+        self.wasted = 0                 # prefetched blocks which were evicted unused
+
+    def __repr__(self):
+        return (f"ReadAhead(window: {self.window}, streams: {len(self.streams)}, "
+                f"hits: {self.hits}, wasted: {self.wasted})")
+
+    def access(self, start, count, next_start=None):
+        """
+        Record read of count blocks from start, next_start is block where stream continues (start + count by default)
+        Return (skip, count) - after skip blocks which are already prefetched from next_start, count blocks
+        should be prefetched, count is 0 if read is not sequential or enough blocks are prefetched
+        """
+        if next_start is None:
+            next_start = start + count
+        ahead = self.streams.pop(start, None)
+        if ahead is None:
+            # new stream, prefetching starts with its second read
+            self._remember(next_start, 0)
+            return 0, 0
+
+        ahead = max(ahead - count, 0)
+        # next batch is prefetched when stream used half of the window
+        prefetch_count = self.window - ahead if ahead <= self.window // 2 else 0
+        self._remember(next_start, ahead + prefetch_count)
+        return ahead, prefetch_count
+
+    def _remember(self, next_start, ahead):
+        self.streams[next_start] = ahead
+        if len(self.streams) > self.max_streams:
+            self.streams.popitem(last=False)
+
+    def prefetch_hit(self):
+        """Prefetched block was used"""
+        self.hits += 1
+        self.window = min(self.max_window, self.window + 1)
+
+    def prefetch_wasted(self):
+        """Prefetched block was evicted without being used"""
+        self.wasted += 1
+        self.window = max(self.min_window, self.window // 2)
+
+    def reset(self):
+        self.streams.clear()
+        self.window = self.min_window
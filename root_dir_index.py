@@ -0,0 +1,120 @@
+import heapq
+from array import array
+
+from fat_dir_entry import FatDirEntry
+from layout import V1_LAYOUT
+
+
+class RootDirIndex:
+    """
+    Root directory loaded in memory as arrays indexed by slot (position of entry in root directory)
+    file name -> slot and heap of free slots for new entries
+    FatDirEntry of file is created when it is asked for the first time and the same one is returned then
+    """
+    def __init__(self, first_block, slot_count, layout=V1_LAYOUT):
+        self.first_block = first_block
+        self.layout = layout
+        self.names = [None] * slot_count                # file name in slot, None if slot is free
+        self.clusters = array(layout.fat_typecode, [0]) * slot_count  # first cluster of file in slot
+        self.sizes = array('I', [0]) * slot_count       # size of file in slot (in clusters)
+        self.slots = {}         # file name -> slot
+        self.fdes = {}          # file name -> FatDirEntry which was already returned
+        self.free_slots = []    # free slots, the first free one is on top
+
+    def __repr__(self):
+        return f"RootDirIndex(files: {len(self.slots)}, free: {len(self.free_slots)})"
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, file_name):
+        return file_name in self.slots
+
+    @classmethod
+    def build(cls, fs):
+        """Read all blocks of root directory once and create index"""
+        first_block = fs.first_root_directory_block()
+        layout = fs.layout
+        index = cls(first_block, fs.root_directory_blocks * layout.entries_per_block, layout)
+
+        root_dir_blocks = fs.cache.read_blocks(first_block, fs.root_directory_blocks, False)
+        for root_dir_block in root_dir_blocks:
+            first_slot = (root_dir_block.block_id - first_block) * layout.entries_per_block
+            for idx, file_name_bytes, fst_cluster_id, size in FatDirEntry.iter_block(root_dir_block.data, layout):
+                slot = first_slot + idx // layout.dir_entry_size
+                if not any(file_name_bytes) and fst_cluster_id == 0 and size == 0:
+                    index.free_slots.append(slot)
+                    continue
+                file_name = file_name_bytes.decode('utf8').rstrip('\0')
+                index.names[slot] = file_name
+                index.clusters[slot] = fst_cluster_id
+                index.sizes[slot] = size
+                # the first entry wins if name is in root directory more than once
+                index.slots.setdefault(file_name, slot)
+
+        heapq.heapify(index.free_slots)
+        return index
+
+    def slot_location(self, slot):
+        """Return (block id, index in block) of slot"""
+        block, entry = divmod(slot, self.layout.entries_per_block)
+        return self.first_block + block, entry * self.layout.dir_entry_size
+
+    def get(self, file_name):
+        """Return FatDirEntry of file or None"""
+        fde = self.fdes.get(file_name)
+        if fde is None:
+            slot = self.slots.get(file_name)
+            if slot is None:
+                return None
+            fde = FatDirEntry(file_name, self.clusters[slot], self.sizes[slot], self.layout)
+            self.fdes[file_name] = fde
+        return fde
+
+    def location(self, file_name):
+        """Return (block id, index in block) of file entry or None"""
+        slot = self.slots.get(file_name)
+        return self.slot_location(slot) if slot is not None else None
+
+    def file_names(self):
+        """Return names of files in order in which they are in root directory"""
+        return [self.names[slot] for slot in sorted(self.slots.values())]
+
+    def occupied_slots(self):
+        """Return slots with entry in order, also slots of names which are in root directory more than once"""
+        return [slot for slot, file_name in enumerate(self.names) if file_name is not None]
+
+    def fat_dir_entries(self):
+        """Return all FatDirEntry in order in which they are in root directory"""
+        return [self.get(file_name) for file_name in self.file_names()]
+
+    def first_free_slot(self):
+        """Return (block id, index in block) of the first free place or None"""
+        return self.slot_location(self.free_slots[0]) if self.free_slots else None
+
+    def add(self, fde):
+        """Put new entry to the first free place and return (block id, index in block), None if directory is full"""
+        if not self.free_slots:
+            return None
+        slot = heapq.heappop(self.free_slots)
+        self.names[slot] = fde.file_name
+        self.slots[fde.file_name] = slot
+        self.fdes[fde.file_name] = fde
+        self.update(fde)
+        return self.slot_location(slot)
+
+    def update(self, fde):
+        """Copy first cluster and size of changed FatDirEntry to arrays"""
+        slot = self.slots[fde.file_name]
+        self.clusters[slot] = fde.fst_cluster_id
+        self.sizes[slot] = fde.size
+
+    def remove(self, file_name):
+        """Remove entry and return its place (block id, index in block) to free places"""
+        slot = self.slots.pop(file_name)
+        self.fdes.pop(file_name, None)
+        self.names[slot] = None
+        self.clusters[slot] = 0
+        self.sizes[slot] = 0
+        heapq.heappush(self.free_slots, slot)
+        return self.slot_location(slot)
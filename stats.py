@@ -0,0 +1,175 @@
+import threading
+from bisect import bisect_left, bisect_right
+from functools import wraps
+from time import perf_counter
+
+# upper bounds of latency histogram buckets in seconds, from 1 microsecond to about 8 seconds
+LATENCY_BOUNDS = [0.000001 * 2 ** i for i in range(24)]
+
+
+class Histogram:
+    """Histogram of latencies, count of bucket is number of values up to its bound (and above the previous one)"""
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # the last bucket is for values above all bounds
+        self.count = 0
+        self.sum = 0.0
+
+    def __repr__(self):
+        return f"Histogram(count: {self.count}, p50: {self.percentile(50)}, p99: {self.percentile(99)})"
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        """Return bound of bucket with given percentile of values (None if there are no values)"""
+        if self.count == 0:
+            return None
+        rank = percent / 100 * self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return self.bounds[idx] if idx < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def cumulative(self):
+        """Return list of (bound, number of values up to bound), the last bound is infinity"""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.percentile(50), 'p99': self.percentile(99),
+                'buckets': {str(bound): count for bound, count in self.cumulative()}}
+
+
+class Stats:
+    """
+    Counters and latency histograms of Cache, its virtual drive and FatFd
+    Counters can be split by class of block (boot, fat, root_dir, data), gauges are read when snapshot is taken
+    hooks - functions called with (name, block class, value) for every counted event and measured latency
+    Nothing is measured if Cache has no Stats, so disabled metrics cost only check of None
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}          # (name, block class or None) -> value
+        self.histograms = {}        # name -> Histogram
+        self.gauges = {}            # name -> function returning current value
+        self.hooks = []
+        self.class_bounds = []      # first block after each class of blocks
+        self.class_names = []
+
+    def __repr__(self):
+        return f"Stats(counters: {len(self.counters)}, histograms: {len(self.histograms)})"
+
+    def set_block_classes(self, classes):
+        """classes - list of (class name, number of blocks) in order from block 0, the rest of blocks is data"""
+        bounds = []
+        end = 0
+        for _, count in classes:
+            end += count
+            bounds.append(end)
+        self.class_bounds = bounds
+        self.class_names = [name for name, _ in classes] + ['data']
+
+    def block_class(self, block_id):
+        if not self.class_names:
+            return 'block'
+        return self.class_names[bisect_right(self.class_bounds, block_id)]
+
+    def inc(self, name, block_id=None, value=1):
+        """Add value to counter, counter is split by class of block if block_id is given"""
+        block_class = self.block_class(block_id) if block_id is not None else None
+        key = (name, block_class)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for hook in self.hooks:
+            hook(name, block_class, value)
+
+    def observe(self, name, seconds):
+        """Add latency to histogram"""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+        for hook in self.hooks:
+            hook(name, None, seconds)
+
+    def drive_io(self, operation, size, seconds):
+        """Count one read/write call of virtual drive with its size in bytes and latency"""
+        self.inc(f'drive_{operation}s')
+        self.inc(f'drive_{operation}_bytes', value=size)
+        self.observe(f'drive_{operation}', seconds)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """Return counters, gauges and histograms as dict"""
+        with self.lock:
+            counters = {}
+            for (name, block_class), value in self.counters.items():
+                if block_class is None:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[block_class] = value
+            histograms = {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+        gauges = {name: gauge() for name, gauge in self.gauges.items()}
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def to_prometheus(self, prefix='fat8'):
+        """Return snapshot in Prometheus text format"""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or ''))
+            histograms = sorted((name, histogram.cumulative(), histogram.sum, histogram.count)
+                                for name, histogram in self.histograms.items())
+
+        typed = set()
+        for (name, block_class), value in counters:
+            metric = f'{prefix}_{name}_total'
+            if metric not in typed:
+                lines.append(f'# TYPE {metric} counter')
+                typed.add(metric)
+            labels = f'{{class="{block_class}"}}' if block_class is not None else ''
+            lines.append(f'{metric}{labels} {value}')
+
+        for name, gauge in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {gauge()}')
+
+        for name, buckets, total, count in histograms:
+            metric = f'{prefix}_{name}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for bound, cumulative in buckets:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum {total}')
+            lines.append(f'{metric}_count {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def timed(name):
+    """Measure latency of FatFd method to histogram name if Cache of its file system has Stats"""
+    def decorator(method):
+        @wraps(method)
+        def measured(self, *args, **kwargs):
+            stats = self.fs.cache.stats
+            if stats is None:
+                return method(self, *args, **kwargs)
+            began = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                stats.observe(name, perf_counter() - began)
+        return measured
+    return decorator
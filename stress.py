@@ -0,0 +1,180 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from time import perf_counter
+
+import fsck
+from benchmark import meta, report, write_report
+from cache import Cache
+from constants import *
+from fat8 import Fat8
+from fat_dir_entry import FatDirEntry
+from fat_file import FatFile
+from mmap_virtual_drive import MmapVirtualDrive
+from stats import Stats
+from virtual_drive import VirtualDrive
+
+MODES = ['write_through', 'write_back', 'mmap']
+
+
+def file_data(name, size):
+    """Return content of file, it differs for every file, so misplaced blocks are found"""
+    seed = zlib.crc32(name.encode()).to_bytes(4, 'little')
+    return (seed * (size // 4 + 1))[:size]
+
+
+def open_drive(path, mode):
+    if mode == 'mmap':
+        return MmapVirtualDrive.open(path)
+    return VirtualDrive.open(path)
+
+
+def add_latency(drive, seconds):
+    """
+    Make every read and write of drive wait like on device with access time, waiting releases GIL as real I/O,
+    so it shows how much I/O of threads overlaps
+    """
+    for name in ('read', 'write', 'read_blocks', 'write_blocks'):
+        def delayed(*args, method=getattr(drive, name)):
+            time.sleep(seconds)
+            return method(*args)
+        setattr(drive, name, delayed)
+
+
+def verify(path, mode, cache_blocks, expected):
+    """
+    Reopen image with new cache, check it by fsck and compare content of files
+    Return (fsck report, names of files with wrong content)
+    """
+    drive = open_drive(path, mode)
+    cache = Cache(drive, cache_blocks)
+    fs = Fat8()
+    fs.open(cache)
+    fsck_report = fsck.fsck(fs)
+    wrong = []
+    names = set(FatDirEntry.read_dir(fs))
+    for name, data in expected.items():
+        if name not in names:
+            wrong.append(name)
+            continue
+        fd = FatFile(fs, name).open()
+        content = bytearray(fd.stat())
+        fd.readinto(content)
+        # size is kept in whole clusters, rest of the last cluster stays zero
+        if content[:len(data)] != data or content.count(0, len(data)) != len(content) - len(data):
+            wrong.append(name)
+    fs.close()
+    drive.close()
+    return fsck_report, wrong
+
+
+def run_once(args, directory, mode, threads):
+    """Write and read files from threads, every thread has its own files, then check image"""
+    path = os.path.join(directory, 'stress.img')
+    if os.path.exists(path):
+        os.remove(path)
+    VirtualDrive.manufacture(path, args.drive_blocks)
+    drive = open_drive(path, mode)
+    if args.latency_us:
+        add_latency(drive, args.latency_us / 1e6)
+    stats = Stats()
+    cache = Cache(drive, args.cache_blocks, mode == 'write_back', stats=stats)
+    fs = Fat8()
+    fs.format(cache, True, args.fs_version)
+    fs.open(cache)
+    stats.reset()
+
+    names = [f's{idx:04d}' for idx in range(args.files)]
+    expected = {name: file_data(name, args.file_size) for name in names}
+    latencies = []
+    errors = []
+
+    def work(own_names):
+        buffer = bytearray(args.file_size)
+        try:
+            for name in own_names:
+                start = perf_counter()
+                fd = FatFile(fs, name).open()
+                data = memoryview(expected[name])
+                fd.write_from(data[position:position + args.chunk] for position in range(0, len(data), args.chunk))
+                fd.seek(0)
+                fd.readinto(buffer)
+                if buffer != expected[name]:
+                    errors.append(f"{name} read back wrong data")
+                # list.append is atomic, latencies of all threads are collected together
+                latencies.append(perf_counter() - start)
+        except Exception as error:
+            errors.append(f"{type(error).__name__}: {error}")
+
+    workers = [threading.Thread(target=work, args=(names[idx::threads],)) for idx in range(threads)]
+    began = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    fs.flush()
+    seconds = perf_counter() - began
+    fs.close()
+    drive.close()
+
+    fsck_report, wrong = verify(path, mode, args.cache_blocks, expected)
+    result = report('stress', {'mode': mode, 'threads': threads, 'files': args.files, 'file_size': args.file_size,
+                               'chunk': args.chunk, 'latency_us': args.latency_us}, latencies, seconds, 2 * args.files * args.file_size, stats)
+    result['errors'] = errors
+    result['fsck_ok'] = fsck_report.ok
+    result['fsck_problems'] = fsck_report.problems()
+    result['wrong_files'] = wrong
+    result['consistent'] = not errors and fsck_report.ok and not wrong
+    os.remove(path)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stress test of threads working on disjoint files of Fat8")
+    parser.add_argument('modes', nargs='*', default=[], help="modes of drive and cache (all by default)")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help="numbers of threads")
+    parser.add_argument('--files', type=int, default=64, help="number of files, they are split among threads")
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help="size of one file in bytes")
+    parser.add_argument('--chunk', type=int, default=4096, help="size of one write in bytes")
+    parser.add_argument('--drive-blocks', type=int, default=20000, help="size of drive in blocks")
+    parser.add_argument('--cache-blocks', type=int, default=256, help="capacity of cache in blocks")
+    parser.add_argument('--latency-us', type=float, default=0,
+                        help="simulated access time of drive in microseconds for every read and write")
+    parser.add_argument('--fs-version', type=int, choices=[1, 2], default=2,
+                        help="version of file system (version 2 has journal of metadata)")
+    parser.add_argument('--dir', default=None, help="directory for images (temporary by default)")
+    parser.add_argument('--output', '-o', default=None, help="write JSON to file instead of standard output")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Run stress test for every mode and number of threads, throughput is compared with one thread"""
+    modes = args.modes or MODES
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode}, choose from {', '.join(MODES)}")
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for mode in modes:
+            baseline = None
+            for threads in args.threads:
+                result = run_once(args, directory, mode, threads)
+                if baseline is None:
+                    baseline = result['seconds']
+                result['speedup'] = baseline / result['seconds'] if result['seconds'] else None
+                results.append(result)
+    return {'meta': meta(args), 'consistent': all(result['consistent'] for result in results), 'results': results}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+    return write_report(result, args.output, result['consistent'])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,168 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+
+from block import Block
+from constants import BLOCK_SIZE
+from virtual_drive import VirtualDrive
+
+# number of consecutive blocks on one member file
+STRIPE_BLOCKS = 16
+# smaller requests are done by calling thread, hand-off to workers costs more than parallel I/O saves
+PARALLEL_BLOCKS = 64
+
+
+class StripedVirtualDrive(VirtualDrive):
+    """
+    Virtual drive striped over more backing files (RAID 0), files can be on different devices
+    Stripes of stripe_blocks blocks go to member files in turn, so consecutive blocks of a request
+    are one range on every member file and requests of more blocks are issued to members in parallel
+    by pool of workers (one per member by default) if they have at least parallel_blocks blocks
+    """
+    def __init__(self, file_names, size, stripe_blocks=STRIPE_BLOCKS, sync=False, workers=None,
+                 parallel_blocks=PARALLEL_BLOCKS):
+        if len(file_names) == 0:
+            raise ValueError("No backing files of drive")
+        if size == 0:
+            raise ValueError("No size of drive")
+        if stripe_blocks < 1:
+            raise ValueError("Stripe has to have at least one block")
+        self.file_name = list(file_names)
+        self.number_of_blocks = size
+        self.size = size * BLOCK_SIZE
+        self.sync_writes = sync
+        self.direct = False
+        self.stripe_blocks = stripe_blocks
+        self.parallel_blocks = parallel_blocks
+
+        member_blocks = self.member_blocks(size, len(file_names), stripe_blocks)
+        self.members = [VirtualDrive(file_name, member_blocks, sync) for file_name in file_names]
+        self.fd = None      # blocks are on backing files of members
+        self.pool = ThreadPoolExecutor(workers or len(self.members))
+
+    @staticmethod
+    def member_blocks(size, members, stripe_blocks=STRIPE_BLOCKS):
+        """Return number of blocks of every member file of drive with size blocks (whole stripes)"""
+        return ceil(size / (stripe_blocks * members)) * stripe_blocks
+
+    @staticmethod
+    def manufacture(file_names, size=0, stripe_blocks=STRIPE_BLOCKS):
+        """Create sparse member files for striped virtual drive with size number of blocks"""
+        if size == 0:
+            raise ValueError("No size of drive")
+        for file_name in file_names:
+            VirtualDrive.manufacture(file_name, StripedVirtualDrive.member_blocks(size, len(file_names), stripe_blocks))
+
+    @classmethod
+    def open(cls, file_names, stripe_blocks=STRIPE_BLOCKS, sync=False, workers=None, parallel_blocks=PARALLEL_BLOCKS):
+        """
+        Open striped virtual drive, stripe_blocks has to be the same as when the drive was manufactured
+        Size of drive is given by the smallest member file
+        """
+        member_blocks = min(os.stat(file_name).st_size for file_name in file_names) // BLOCK_SIZE
+        stripes = member_blocks // stripe_blocks
+        return cls(file_names, stripes * stripe_blocks * len(file_names), stripe_blocks, sync, workers, parallel_blocks)
+
+    def _locate(self, block_id):
+        """Return (member, block id on member) of block"""
+        stripe, offset = divmod(block_id, self.stripe_blocks)
+        row, member = divmod(stripe, len(self.members))
+        return self.members[member], row * self.stripe_blocks + offset
+
+    def _runs(self, start, count):
+        """
+        Split count consecutive blocks to members
+        Return list of (member, first block on member, [(index in request, number of blocks)]),
+        blocks of one member are consecutive on it
+        """
+        runs = {}
+        idx = 0
+        while idx < count:
+            stripe, offset = divmod(start + idx, self.stripe_blocks)
+            length = min(self.stripe_blocks - offset, count - idx)
+            row, member = divmod(stripe, len(self.members))
+            if member not in runs:
+                runs[member] = (self.members[member], row * self.stripe_blocks + offset, [])
+            runs[member][2].append((idx, length))
+            idx += length
+        return list(runs.values())
+
+    def _run_parallel(self, function, runs, parallel=True):
+        """Call function for every run, with parallel runs of more members are done by pool of workers"""
+        if len(runs) == 1 or not parallel:
+            for run in runs:
+                function(run)
+            return
+        for future in [self.pool.submit(function, run) for run in runs]:
+            future.result()
+
+    def read(self, block_id):
+        """Read one block from its member file"""
+        self._check_block_id(block_id)
+        member, member_block_id = self._locate(block_id)
+        return member.read(member_block_id)
+
+    def write(self, block):
+        """Write block to its member file"""
+        self._check_block_id(block.block_id)
+        member, member_block_id = self._locate(block.block_id)
+        member.write(Block(member_block_id, False, block.data))
+
+    def read_blocks(self, start, count):
+        """Read count consecutive blocks, every member file is read with one call and members in parallel"""
+        self._check_block_id(start)
+        self._check_block_id(start + count - 1)
+        data = bytearray(count * BLOCK_SIZE)
+
+        def read_run(run):
+            member, member_start, pieces = run
+            member_data = memoryview(member.read_blocks(member_start, sum(length for _, length in pieces)))
+            position = 0
+            for idx, length in pieces:
+                data[idx * BLOCK_SIZE:(idx + length) * BLOCK_SIZE] = member_data[position:position + length * BLOCK_SIZE]
+                position += length * BLOCK_SIZE
+
+        self._run_parallel(read_run, self._runs(start, count), count >= self.parallel_blocks)
+        return data
+
+    def write_blocks(self, start, buffers):
+        """Write consecutive blocks, every member file is written with one call and members in parallel"""
+        if len(buffers) == 0:
+            return
+        self._check_block_id(start)
+        self._check_block_id(start + len(buffers) - 1)
+        for buffer in buffers[:-1]:
+            if len(buffer) != BLOCK_SIZE:
+                raise ValueError("Only the last buffer can be shorter than block")
+
+        def write_run(run):
+            member, member_start, pieces = run
+            member.write_blocks(member_start, [buffer for idx, length in pieces for buffer in buffers[idx:idx + length]])
+
+        self._run_parallel(write_run, self._runs(start, len(buffers)), len(buffers) >= self.parallel_blocks)
+
+    def discard(self, start, count):
+        """Set count consecutive blocks to zeros on member files"""
+        if count == 0:
+            return
+        self._check_block_id(start)
+        self._check_block_id(start + count - 1)
+
+        def discard_run(run):
+            member, member_start, pieces = run
+            member.discard(member_start, sum(length for _, length in pieces))
+
+        self._run_parallel(discard_run, self._runs(start, count), count >= self.parallel_blocks)
+
+    def sync(self):
+        """Make all written blocks durable on all member files"""
+        self._run_parallel(lambda member: member.sync(), self.members)
+
+    def close(self):
+        """Close all member files and stop workers"""
+        if not self.members:
+            return
+        self.pool.shutdown()
+        for member in self.members:
+            member.close()
+        self.members = []
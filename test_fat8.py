@@ -0,0 +1,224 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import fsck
+from aio import AsyncFat8
+from cache import Cache, LATCHES
+from constants import *
+from fat8 import Fat8
+from fat_file import FatFile
+from stats import Stats
+from virtual_drive import VirtualDrive
+
+
+class DriveTestCase(unittest.TestCase):
+    """Fresh virtual drive in temporary directory for every test"""
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'drive')
+        self.drives = []
+
+    def tearDown(self):
+        for drive in self.drives:
+            drive.close()
+        shutil.rmtree(self.directory)
+
+    def open_fs(self, blocks=None, cache_blocks=16, stats=None, **format_args):
+        """Open file system on drive, it is formatted if size of new drive is given"""
+        if blocks is not None:
+            VirtualDrive.manufacture(self.path, blocks)
+        drive = VirtualDrive.open(self.path)
+        self.drives.append(drive)
+        fs = Fat8()
+        if blocks is not None:
+            fs.format(Cache(drive, cache_blocks), **format_args)
+        fs.open(Cache(drive, cache_blocks, stats=stats))
+        return fs
+
+
+class CacheTest(DriveTestCase):
+    def test_write_back_writes_dirty_blocks_in_batches(self):
+        VirtualDrive.manufacture(self.path, 256)
+        drive = VirtualDrive.open(self.path)
+        self.drives.append(drive)
+        stats = Stats()
+        cache = Cache(drive, 16, True, stats=stats)
+        for block_id in range(128):
+            cache.write(block_id, bytes([block_id]) * BLOCK_SIZE)
+        cache.flush()
+        self.assertLessEqual(stats.snapshot()['counters']['drive_writes'], 128 // 4)
+        self.assertEqual(drive.read(100), bytes([100]) * BLOCK_SIZE)
+
+    def test_read_is_stale_only_for_blocks_written_meanwhile(self):
+        VirtualDrive.manufacture(self.path, 256)
+        drive = VirtualDrive.open(self.path)
+        self.drives.append(drive)
+        stats = Stats()
+        cache = Cache(drive, 64, stats=stats)
+
+        def read_blocks(start, count, method=drive.read_blocks):
+            data = method(start, count)
+            if start == 0:
+                # block in read range and block of the same latch outside of it are written during read
+                cache.write(5, b'5' * BLOCK_SIZE)
+                cache.write(LATCHES + 8, b'8' * BLOCK_SIZE)
+            return data
+        drive.read_blocks = read_blocks
+
+        blocks = cache.read_blocks(0, 32, False)
+        self.assertEqual(bytes(blocks[5].data), b'5' * BLOCK_SIZE)
+        # written block is taken from cache, no block is read again
+        self.assertEqual(stats.snapshot()['counters']['drive_reads'], 1)
+        self.assertEqual(cache.versions, {})
+
+
+class LayoutV1Test(DriveTestCase):
+    def test_fill_drive_not_multiple_of_256_blocks(self):
+        for blocks in (5000, 7777, 8000):
+            with self.subTest(blocks=blocks):
+                fs = self.open_fs(blocks)
+                self.assertLessEqual(fs._first_data_block() + fs.data_blocks, blocks)
+                cluster_size = fs.blocks_per_clust * BLOCK_SIZE
+                for idx in range(FAT_MAX_CLUSTERS):
+                    FatFile(fs, f'f{idx}').open().write_from([bytes([idx]) * cluster_size])
+                self.assertEqual(fs.free_clusters_count(), 0)
+                fs.close()
+
+                fs = self.open_fs()
+                self.assertTrue(fsck.fsck(fs).ok)
+                data = bytearray(cluster_size)
+                FatFile(fs, f'f{FAT_MAX_CLUSTERS - 1}').open().readinto(data)
+                self.assertEqual(data, bytes([FAT_MAX_CLUSTERS - 1]) * cluster_size)
+                fs.close()
+
+    def test_truncate_to_all_clusters(self):
+        fs = self.open_fs(5000)
+        fd = FatFile(fs, 'big').open()
+        fd.truncate(FAT_MAX_CLUSTERS * fd.cluster_size)
+        fd.seek(fd.stat() - 1)
+        fd.write_from([b'x'])
+        self.assertEqual(fs.free_clusters_count(), 0)
+
+
+class FormatTest(DriveTestCase):
+    def test_format_over_garbage(self):
+        for version in (1, 2):
+            for quick in (True, False):
+                with self.subTest(version=version, quick=quick):
+                    with open(self.path, 'wb') as image:
+                        image.write(b'\xa5' * 3000 * BLOCK_SIZE)
+                    drive = VirtualDrive.open(self.path)
+                    self.drives.append(drive)
+                    fs = Fat8()
+                    fs.format(Cache(drive, 16), quick, version)
+                    fs.open(Cache(drive, 16))
+                    self.assertTrue(fsck.fsck(fs).ok)
+                    fd = FatFile(fs, 'big').open()
+                    fd.truncate(fs.free_clusters_count() * fd.cluster_size + fd.cluster_size)
+                    data = bytearray(fd.stat())
+                    fd.readinto(data)
+                    self.assertEqual(data.count(0), len(data))
+                    fs.close()
+
+
+class FatDirEntryTest(DriveTestCase):
+    def test_too_long_name_does_not_leak_cluster(self):
+        for version in (1, 2):
+            with self.subTest(version=version):
+                fs = self.open_fs(3000, version=version)
+                free = fs.free_clusters_count()
+                with self.assertRaises(ValueError):
+                    FatFile(fs, 'n' * (fs.layout.file_name_max_size + 1)).open()
+                self.assertEqual(fs.free_clusters_count(), free)
+                fs.close()
+                self.assertTrue(fsck.fsck(self.open_fs()).ok)
+
+
+class FatFdTest(DriveTestCase):
+    def test_descriptors_share_cluster_chain(self):
+        for version in (1, 2):
+            with self.subTest(version=version):
+                fs = self.open_fs(3000, version=version)
+                first = FatFile(fs, 'a').open()
+                second = FatFile(fs, 'a').open()
+                cluster_size = first.cluster_size
+                first.write_from([b'1' * 4 * cluster_size])
+                # other descriptor shrinks file, freed clusters go to other file
+                second.truncate(cluster_size)
+                fs.flush()
+                FatFile(fs, 'b').open().write_from([b'2' * 3 * cluster_size])
+                self.assertEqual(first.stat(), cluster_size)
+                first.seek(first.stat())
+                first.write_from([b'3' * cluster_size])
+                self.assertEqual(second.stat(), 2 * cluster_size)
+                fs.close()
+
+                fs = self.open_fs()
+                self.assertTrue(fsck.fsck(fs).ok)
+                data = bytearray(3 * cluster_size)
+                FatFile(fs, 'b').open().readinto(data)
+                self.assertEqual(data, b'2' * 3 * cluster_size)
+                data = bytearray(2 * cluster_size)
+                FatFile(fs, 'a').open().readinto(data)
+                self.assertEqual(data, b'1' * cluster_size + b'3' * cluster_size)
+                fs.close()
+
+    def test_partial_write_reads_only_edge_blocks(self):
+        stats = Stats()
+        fs = self.open_fs(3000, version=2, blocks_per_cluster=8, stats=stats)
+        fd = FatFile(fs, 'a').open()
+        fd.truncate(2 * fd.cluster_size)
+        expected = bytearray(fd.stat())
+        stats.reset()
+        # new clusters are zero, so nothing is read
+        fd.seek(100)
+        fd.write_from([b'x' * (2 * BLOCK_SIZE)])
+        expected[100:100 + 2 * BLOCK_SIZE] = b'x' * (2 * BLOCK_SIZE)
+        self.assertNotIn('drive_reads', stats.snapshot()['counters'])
+
+        # written cluster is read only in partly overwritten block
+        fs.cache.clear_cache()
+        stats.reset()
+        fd.seek(3 * BLOCK_SIZE + 10)
+        fd.write_from([b'y' * 20])
+        expected[3 * BLOCK_SIZE + 10:3 * BLOCK_SIZE + 30] = b'y' * 20
+        self.assertEqual(stats.snapshot()['counters']['drive_read_bytes'], BLOCK_SIZE)
+        fs.close()
+
+        fs = self.open_fs()
+        data = bytearray(len(expected))
+        FatFile(fs, 'a').open().readinto(data)
+        self.assertEqual(data, expected)
+        fs.close()
+
+
+class AsyncFatFdTest(DriveTestCase):
+    def test_reads_of_same_range_share_one_call(self):
+        fs = self.open_fs(3000, version=2)
+        FatFile(fs, 'a').open().write_from([b'a' * 5000])
+        calls = []
+
+        async def main():
+            async with AsyncFat8(fs) as afs:
+                fds = [await afs.file('a').open() for _ in range(3)]
+                for fd in fds:
+                    def pread(position, size, method=fd.fat_fd.pread):
+                        calls.append(position)
+                        return method(position, size)
+                    fd.fat_fd.pread = pread
+                buffers = [bytearray(4000) for _ in fds]
+                self.assertEqual(await asyncio.gather(*(fd.readinto(buffer) for fd, buffer in zip(fds, buffers))),
+                                 [4000] * 3)
+                self.assertEqual(buffers, [b'a' * 4000] * 3)
+                self.assertEqual([await fd.tell() for fd in fds], [4000] * 3)
+                self.assertEqual(await fds[0].read(1000), 'a' * 1000)
+
+        asyncio.run(main())
+        self.assertEqual(calls, [0, 4000])
+
+
+if __name__ == '__main__':
+    unittest.main()
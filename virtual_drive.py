@@ -1,54 +1,191 @@
+import ctypes
+import ctypes.util
+import mmap
 import os
 from constants import BLOCK_SIZE
 
+# maximum number of buffers for one pwritev call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# flags of fallocate, hole is punched without changing size of file
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+# number of zero blocks written with one call if hole can not be punched
+ZERO_BLOCKS_PER_WRITE = 256
+
+
+def _load_fallocate():
+    """Return fallocate from C library or None if it is not available"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
 
 class VirtualDrive:
-    """Class of virtual drive with name and size"""
-    def __init__(self, file_name, size):
+    """
+    Class of virtual drive with name and size
+    Backing file is opened once and blocks are accessed with positional I/O on it
+    sync - every write is followed by fsync, direct - page cache is bypassed with O_DIRECT
+    """
+    def __init__(self, file_name, size, sync=False, direct=False):
         self.file_name = file_name
         self.number_of_blocks = size
         if size == 0:
             raise ValueError("No size of drive")
         self.size = size * BLOCK_SIZE
+        self.sync_writes = sync
+        self.direct = direct
+
+        flags = os.O_RDWR
+        if direct:
+            if not hasattr(os, 'O_DIRECT'):
+                raise ValueError("O_DIRECT is not supported on this platform")
+            flags |= os.O_DIRECT
+        self.fd = os.open(file_name, flags)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     @staticmethod
     def manufacture(file_name, size=0):
-        """Create instance of virtual drive"""
+        """Create sparse file for virtual drive with size number of blocks"""
         if size == 0:
             raise ValueError("No size of drive")
 
-        os.open(file_name, os.O_CREAT)
-        fd = os.open(file_name, os.O_RDWR)
-        os.ftruncate(fd, size)
-        os.close(fd)
+        fd = os.open(file_name, os.O_CREAT | os.O_RDWR, 0o666)
+        try:
+            os.ftruncate(fd, size * BLOCK_SIZE)
+        finally:
+            os.close(fd)
 
     @classmethod
-    def open(cls, file_name):
+    def open(cls, file_name, sync=False, direct=False):
         """Open virtual drive and return instance of VirtualDrive class"""
         file_stats = os.stat(file_name)
-        return cls(file_name, file_stats.st_size)
+        return cls(file_name, file_stats.st_size // BLOCK_SIZE, sync, direct)
+
+    def _check_block_id(self, block_id):
+        if not 0 <= block_id < self.number_of_blocks:
+            raise ValueError("Block id is not in range of file")
 
     def read(self, block_id):
         """Read one block from virtual drive"""
-        if 0 <= block_id < self.number_of_blocks:
-            with open(self.file_name, 'rb') as file:
-                file.seek((block_id * BLOCK_SIZE))
-                data = file.read(BLOCK_SIZE)
-                return data
-        else:
-            return ValueError("Block id is not in range of file")
+        self._check_block_id(block_id)
+        position = block_id * BLOCK_SIZE
+        if self.direct:
+            # O_DIRECT needs aligned buffer, every call has its own, so threads can read at once
+            return bytes(self.read_blocks(block_id, 1))
+
+        data = os.pread(self.fd, BLOCK_SIZE, position)
+        if len(data) < BLOCK_SIZE:
+            # part of file behind its end
+            data = data.ljust(BLOCK_SIZE, b'\0')
+        return data
 
     def write(self, block):
         """Write block to virtual drive"""
-        if 0 <= block.block_id < self.number_of_blocks:
-            with open(self.file_name, 'r+b') as file:
-                position = block.block_id * BLOCK_SIZE
-                file.seek(position)
-                file.write(block.data)
+        self._check_block_id(block.block_id)
+        if self.direct:
+            # aligned buffer of the call keeps rest of block as it is on drive
+            self.write_blocks(block.block_id, [block.data])
+            return
+
+        os.pwrite(self.fd, block.data, block.block_id * BLOCK_SIZE)
+        if self.sync_writes:
+            os.fsync(self.fd)
+
+    def read_blocks(self, start, count):
+        """Read count consecutive blocks from virtual drive with one call"""
+        self._check_block_id(start)
+        self._check_block_id(start + count - 1)
+        position = start * BLOCK_SIZE
+        if self.direct:
+            # anonymous map is page aligned as O_DIRECT needs
+            buffer = mmap.mmap(-1, count * BLOCK_SIZE)
+            try:
+                os.preadv(self.fd, [buffer], position)
+                return bytearray(buffer)
+            finally:
+                buffer.close()
+
+        data = bytearray(count * BLOCK_SIZE)
+        # part of file behind its end stays zero
+        os.preadv(self.fd, [data], position)
+        return data
+
+    def write_blocks(self, start, buffers):
+        """Write consecutive blocks to virtual drive, only the last buffer can be shorter than block"""
+        if len(buffers) == 0:
+            return
+        self._check_block_id(start)
+        self._check_block_id(start + len(buffers) - 1)
+        for buffer in buffers[:-1]:
+            if len(buffer) != BLOCK_SIZE:
+                raise ValueError("Only the last buffer can be shorter than block")
+
+        position = start * BLOCK_SIZE
+        if self.direct:
+            # O_DIRECT writes whole blocks, keep rest of last block as it is on drive
+            buffer = mmap.mmap(-1, len(buffers) * BLOCK_SIZE)
+            try:
+                last_position = (len(buffers) - 1) * BLOCK_SIZE
+                if len(buffers[-1]) < BLOCK_SIZE:
+                    os.preadv(self.fd, [memoryview(buffer)[last_position:]], position + last_position)
+                for idx, data in enumerate(buffers):
+                    buffer[idx * BLOCK_SIZE:idx * BLOCK_SIZE + len(data)] = data
+                os.pwritev(self.fd, [buffer], position)
+            finally:
+                buffer.close()
         else:
-            return ValueError("Block id is not in range of file")
+            for idx in range(0, len(buffers), IOV_MAX):
+                os.pwritev(self.fd, buffers[idx:idx + IOV_MAX], position + idx * BLOCK_SIZE)
+
+        if self.sync_writes:
+            os.fsync(self.fd)
+
+    def _punch_hole(self, position, length):
+        """Deallocate part of backing file, it is read as zeros then, return False if it is not supported"""
+        if _fallocate is None:
+            return False
+        return _fallocate(self.fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, position, length) == 0
+
+    def discard(self, start, count):
+        """Set count consecutive blocks to zeros, space of blocks is released from backing file if it is possible"""
+        if count == 0:
+            return
+        self._check_block_id(start)
+        self._check_block_id(start + count - 1)
+
+        if not self._punch_hole(start * BLOCK_SIZE, count * BLOCK_SIZE):
+            zero_block = bytes(BLOCK_SIZE)
+            for block_id in range(start, start + count, ZERO_BLOCKS_PER_WRITE):
+                blocks = min(ZERO_BLOCKS_PER_WRITE, start + count - block_id)
+                self.write_blocks(block_id, [zero_block] * blocks)
+        elif self.sync_writes:
+            os.fsync(self.fd)
+
+    def sync(self):
+        """Make all written blocks durable on backing file"""
+        os.fsync(self.fd)
+
+    def close(self):
+        """Close backing file of virtual drive"""
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
 
     def stat(self):
         """Return size of virtual drive"""
         return self.size
-